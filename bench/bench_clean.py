@@ -0,0 +1,183 @@
+"""
+Offline cleaning benchmark. For each size it generates seeded dirty data with
+gen_dirty.py, loads it into a fresh SQLite database and runs each cleaning
+method in its own process, reporting wall time, pairs compared, peak memory
+and pairwise precision/recall against the generator's ground truth.
+
+    python bench_clean.py --sizes 10000,100000 --methods all-pairs,blocking,blocking-split:200,blocker:qgram
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server")
+sys.path.insert(0, SERVER_DIR)
+
+from db import DB  # noqa: E402
+from blocking import make_blocker  # noqa: E402
+from normalize import normalize_restaurant  # noqa: E402
+from gen_dirty import generate  # noqa: E402
+
+
+def build_database(path, values):
+    """
+    Creates the schema and bulk loads one restaurant per record, keeping the
+    generator's entity ids in bench_truth.
+    """
+    conn = sqlite3.connect(path)
+    cwd = os.getcwd()
+    os.chdir(SERVER_DIR)  # create_script reads schema/create.sql relative to the server
+    try:
+        DB(conn).create_script()
+    finally:
+        os.chdir(cwd)
+    c = conn.cursor()
+    c.execute("CREATE TABLE bench_truth (restaurant_id int PRIMARY KEY, entity_id int)")
+    for v in values:
+        c.execute("""INSERT INTO ri_restaurants (name, facility_type, address, city, state, zip, latitude, longitude,
+                                                 name_norm, address_norm, city_norm)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                  (v["name"], v["facility_type"], v["address"], v["city"], v["state"], v["zip"],
+                   v["latitude"], v["longitude"]) + normalize_restaurant(v))
+        restaurant_id = c.lastrowid
+        c.execute("""INSERT INTO ri_inspections (id, risk, inspection_date, inspection_type, results, violations, restaurant_id)
+                     VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                  (v["inspection_id"], v["risk"], datetime.strptime(v["date"], "%m/%d/%Y").date().isoformat(), v["inspection_type"],
+                   v["results"], v["violations"], restaurant_id))
+        c.execute("INSERT INTO bench_truth (restaurant_id, entity_id) VALUES (?, ?)", (restaurant_id, v["entity_id"]))
+    conn.commit()
+    # inserted directly, so the rollup the clean corrects is built afterwards
+    DB(conn).rebuild_rollup()
+    conn.close()
+
+
+def pairs(counter):
+    return sum(n * (n - 1) // 2 for n in counter.values())
+
+
+def evaluate(conn):
+    """
+    Pairwise precision and recall of the ri_linked clusters against bench_truth.
+    """
+    rows = conn.execute("""SELECT t.entity_id, min(l.primary_rest_id) FROM bench_truth t
+                           JOIN ri_linked l ON l.original_rest_id = t.restaurant_id
+                           GROUP BY t.restaurant_id""").fetchall()
+    true_positives = pairs(Counter(rows))
+    predicted = pairs(Counter(primary for _, primary in rows))
+    actual = pairs(Counter(entity for entity, _ in rows))
+    return {
+        "precision": round(true_positives / predicted, 4) if predicted else 1.0,
+        "recall": round(true_positives / actual, 4) if actual else 1.0,
+    }
+
+
+def run_method(template, method, results):
+    # runs in a child process so peak memory is measured per method
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    shutil.copyfile(template, path)
+    try:
+        conn = sqlite3.connect(path)
+        db = DB(conn)
+        start = time.perf_counter()
+        if method == "all-pairs":
+            stats = db.match_restaurant()
+        elif method == "blocking":
+            stats = db.match_restaurant_blocking()
+        elif method == "blocking-stream":
+            stats = db.match_restaurant_blocking(stream=True)
+        elif method.startswith("blocking-split:"):
+            stats = db.match_restaurant_blocking(max_block_size=int(method.split(":", 1)[1]))
+        elif method == "incremental":
+            stats = db.match_restaurant_incremental()
+        elif method.startswith("blocker:"):
+            stats = db.match_restaurant_blocker(make_blocker(method.split(":", 1)[1]))
+        else:
+            raise ValueError("Unknown method %s" % method)
+        elapsed = time.perf_counter() - start
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        peak_mb = peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+        result = {"method": method, "seconds": round(elapsed, 3),
+                  "pairs_compared": stats["matching"]["pairs"], "peak_mb": round(peak_mb, 1)}
+        result.update(evaluate(conn))
+        conn.close()
+        results.put(result)
+    finally:
+        os.remove(path)
+
+
+def wait_for_result(child, results, poll_seconds=1.0):
+    """
+    Returns what the child put on results, or None once it has exited without.
+    """
+    while True:
+        try:
+            return results.get(timeout=poll_seconds)
+        except queue.Empty:
+            if not child.is_alive():
+                # the child may have put its result just before exiting
+                try:
+                    return results.get(timeout=poll_seconds)
+                except queue.Empty:
+                    return None
+
+
+def run_benchmark(sizes, methods, seed, max_all_pairs):
+    rows = []
+    ctx = multiprocessing.get_context("spawn")
+    for size in sizes:
+        fd, template = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        try:
+            build_database(template, generate(size, seed))
+            for method in methods:
+                if method == "all-pairs" and size > max_all_pairs:
+                    print("Skipping all-pairs for %d rows (over --max-all-pairs)" % size)
+                    continue
+                results = ctx.Queue()
+                child = ctx.Process(target=run_method, args=(template, method, results))
+                child.start()
+                result = wait_for_result(child, results)
+                child.join()
+                if result is None:
+                    print("%s failed for %d rows (exit code %s)" % (method, size, child.exitcode))
+                    continue
+                result["rows"] = size
+                rows.append(result)
+                print("%8d %-18s %9.3fs %14d pairs %8.1f MB  precision %.4f  recall %.4f" % (
+                    size, method, result["seconds"], result["pairs_compared"], result["peak_mb"],
+                    result["precision"], result["recall"]))
+        finally:
+            os.remove(template)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark restaurant cleaning on synthetic dirty data")
+    parser.add_argument("--sizes", help="Comma separated row counts (default 10000,100000,1000000)",
+                        default="10000,100000,1000000")
+    parser.add_argument("--methods", help="Comma separated: all-pairs, blocking, blocking-stream, blocking-split:<max block size>, incremental, blocker:<name>",
+                        default="all-pairs,blocking")
+    parser.add_argument("--seed", help="Random seed (default 30235)", default=30235, type=int)
+    parser.add_argument("--max-all-pairs", help="Skip all-pairs above this many rows (default 20000)",
+                        default=20000, type=int)
+    parser.add_argument("-o", "--out", help="Also write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = run_benchmark([int(s) for s in args.sizes.split(",")], args.methods.split(","),
+                            args.seed, args.max_all_pairs)
+    if args.out:
+        with open(args.out, "w") as out_file:
+            json.dump(results, out_file, indent=1)
@@ -0,0 +1,155 @@
+"""
+Generates seeded synthetic dirty restaurant inspections for cleaning benchmarks.
+Every restaurant (entity) is emitted one or more times with the kind of dirt
+found in the Chicago data: typos, dropped characters, abbreviated or expanded
+street types and directions, corporate suffixes, trailing spaces and misspelt
+cities. Each record carries an entity_id so cleaning can be scored against
+the ground truth.
+
+The output uses the client test file format (post_path/values), so it can be
+loaded with client/client.py as well as by bench_clean.py.
+"""
+import argparse
+import json
+import random
+
+NAME_WORDS = ["GOLDEN", "DRAGON", "TAQUERIA", "EL", "LA", "PIZZA", "GRILL", "CAFE", "KITCHEN", "BURGER",
+              "HOUSE", "EXPRESS", "THAI", "SUSHI", "WOK", "MEXICAN", "FOOD", "MART", "LIQUOR", "BAKERY",
+              "TACO", "JUICE", "BAR", "PUB", "TAVERN", "DELI", "BBQ", "GYROS", "CHICKEN", "FISH", "NOODLE",
+              "PHO", "CANTINA", "COFFEE", "ROASTERS", "GROCERY", "MINI", "PALACE", "GARDEN", "STAR", "LUCKY",
+              "HAPPY", "CITY", "WINDY", "LAKE", "SOUTH", "NORTH", "MAMA", "PAPA", "ROYAL", "BLUE", "RED"]
+CHAINS = ["SUBWAY", "MCDONALD'S", "DUNKIN DONUTS", "STARBUCKS", "7 - ELEVEN", "CHIPOTLE MEXICAN GRILL",
+          "POTBELLY SANDWICH WORKS", "JIMMY JOHN'S", "WENDY'S", "HAROLD'S CHICKEN SHACK"]
+CORPORATE = ["INC", "INC.", "LLC", "CORP", "CO."]
+STREETS = ["LINCOLN", "CLARK", "HALSTED", "ASHLAND", "WESTERN", "CICERO", "PULASKI", "DAMEN", "MILWAUKEE",
+           "ARCHER", "ROOSEVELT", "DIVISION", "NORTH", "CHICAGO", "MADISON", "BELMONT", "FULLERTON",
+           "IRVING PARK", "LAWRENCE", "DEVON", "TOUHY", "WENTWORTH", "STATE", "MICHIGAN", "WABASH", "GRAND",
+           "OHIO", "ONTARIO", "KEDZIE", "CENTRAL", "HARLEM", "CERMAK", "63RD", "79TH", "87TH", "95TH"]
+STREET_TYPES = [("AVE", "AVENUE"), ("ST", "STREET"), ("BLVD", "BOULEVARD"), ("RD", "ROAD"), ("DR", "DRIVE")]
+DIRECTIONS = [("N", "NORTH"), ("S", "SOUTH"), ("E", "EAST"), ("W", "WEST")]
+CITY_DIRT = ["CHCAGO", "CHICAGO.", "CHICAGOCHICAGO", "CHICAGOI", "CCHICAGO", "Chicago", "CHICAG"]
+# downtown zips are listed several times so they produce the dense blocks seen in the real data
+ZIPS = ["60601", "60602", "60603", "60604", "60605", "60606", "60607", "60610", "60611", "60654", "60661"] * 3 + \
+       ["606%02d" % z for z in range(8, 61)]
+FACILITY_TYPES = ["Restaurant", "Grocery Store", "School", "Bakery", "Daycare (2 - 6 Years)", "Liquor"]
+RISKS = ["Risk 1 (High)", "Risk 2 (Medium)", "Risk 3 (Low)"]
+RESULTS = ["Pass", "Fail", "Pass w/ Conditions", "Out of Business", "No Entry"]
+INSPECTION_TYPES = ["Canvass", "License", "Complaint", "Canvass Re-Inspection", "Short Form Complaint"]
+LETTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+
+def make_entity(rng):
+    if rng.random() < 0.1:
+        name = rng.choice(CHAINS)
+    else:
+        name = " ".join(rng.choice(NAME_WORDS) for _ in range(rng.randint(1, 3)))
+        if rng.random() < 0.3:
+            name += " " + rng.choice(CORPORATE)
+    direction = rng.choice(DIRECTIONS)
+    street_type = rng.choice(STREET_TYPES)
+    return {
+        "name": name,
+        "number": str(rng.randint(1, 12999)),
+        "direction": direction,
+        "street": rng.choice(STREETS),
+        "street_type": street_type,
+        "zip": rng.choice(ZIPS),
+        "facility_type": rng.choice(FACILITY_TYPES),
+        "latitude": 41.65 + rng.random() * 0.37,
+        "longitude": -87.92 + rng.random() * 0.40,
+    }
+
+
+def typo(rng, value):
+    # substitute, drop or transpose one character (never the first, which most blockers key on)
+    if len(value) < 3:
+        return value
+    i = rng.randint(1, len(value) - 2)
+    op = rng.random()
+    if op < 0.4:
+        return value[:i] + rng.choice(LETTERS) + value[i + 1:]
+    if op < 0.7:
+        return value[:i] + value[i + 1:]
+    return value[:i] + value[i + 1] + value[i] + value[i + 2:]
+
+
+def dirty_name(rng, name):
+    if rng.random() < 0.4:
+        name = typo(rng, name)
+    if rng.random() < 0.15:
+        for suffix in CORPORATE:
+            if name.endswith(" " + suffix):
+                name = name[:-len(suffix) - 1]
+                break
+        else:
+            name += " " + rng.choice(CORPORATE)
+    if rng.random() < 0.03:
+        # the occasional first letter typo that defeats prefix blocking
+        name = rng.choice(LETTERS) + name[1:]
+    return name
+
+
+def dirty_address(rng, entity):
+    direction = entity["direction"][1] if rng.random() < 0.1 else entity["direction"][0]
+    street_type = entity["street_type"][1] if rng.random() < 0.15 else entity["street_type"][0]
+    street = typo(rng, entity["street"]) if rng.random() < 0.3 else entity["street"]
+    number = entity["number"]
+    if rng.random() < 0.05:
+        number = "%s-%d" % (number, int(number) + rng.randint(1, 8))
+    address = "%s %s %s %s" % (number, direction, street, street_type)
+    if rng.random() < 0.5:
+        address += " "
+    return address
+
+
+def generate(rows, seed=30235, duplicate_rate=0.35):
+    """
+    Returns a list of client-format inspection values with an entity_id each.
+    duplicate_rate is the chance an entity gets another (dirty) record.
+    """
+    rng = random.Random(seed)
+    values = []
+    entity_id = 0
+    while len(values) < rows:
+        entity_id += 1
+        entity = make_entity(rng)
+        copies = 1
+        while rng.random() < duplicate_rate and copies < 8:
+            copies += 1
+        for copy in range(min(copies, rows - len(values))):
+            clean = copy == 0
+            values.append({
+                "inspection_id": str(1000000 + len(values)),
+                "name": entity["name"] if clean else dirty_name(rng, entity["name"]),
+                "facility_type": entity["facility_type"],
+                "risk": rng.choice(RISKS),
+                "address": "%s %s %s %s" % (entity["number"], entity["direction"][0], entity["street"],
+                                            entity["street_type"][0]) if clean else dirty_address(rng, entity),
+                "city": "CHICAGO" if clean or rng.random() > 0.1 else rng.choice(CITY_DIRT),
+                "state": "IL",
+                "zip": entity["zip"],
+                "date": "%02d/%02d/%d" % (rng.randint(1, 12), rng.randint(1, 28), rng.randint(2010, 2023)),
+                "inspection_type": rng.choice(INSPECTION_TYPES),
+                "results": rng.choice(RESULTS),
+                "violations": "",
+                "latitude": "%.9f" % (entity["latitude"] + rng.uniform(-0.0001, 0.0001)),
+                "longitude": "%.9f" % (entity["longitude"] + rng.uniform(-0.0001, 0.0001)),
+                "entity_id": entity_id,
+            })
+    # records of the same restaurant arrive at different times
+    rng.shuffle(values)
+    return values
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic dirty restaurant inspections")
+    parser.add_argument("-n", "--rows", help="Number of inspection records (default 10000)", default=10000, type=int)
+    parser.add_argument("--seed", help="Random seed (default 30235)", default=30235, type=int)
+    parser.add_argument("-o", "--out", help="Output test file (default dirty-<rows>.json)")
+    args = parser.parse_args()
+
+    out = args.out or "dirty-%d.json" % args.rows
+    with open(out, "w") as out_file:
+        json.dump({"post_path": "inspections", "response": [200, 201], "values": generate(args.rows, args.seed)},
+                  out_file)
+    print("Wrote %d records to %s" % (args.rows, out))
@@ -2,10 +2,17 @@ import json
 import argparse
 import sys
 import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from requests.exceptions import ConnectionError, ConnectTimeout
 from collections import defaultdict
 from os import path
 
+# Sessions, one per thread so test files run in parallel do not share one. They only
+# reuse connections when the server keeps them open: the single-threaded Flask dev
+# server answers HTTP/1.0 and closes every connection.
+sessions = threading.local()
+
 
 class LoaderError(Exception):
     def __init__(self, message=None):
@@ -51,6 +58,31 @@ def validate_script(script_file):
                                           % (test_file, test_file_json.keys()))
 
 
+def get_session():
+    if not hasattr(sessions, "session"):
+        sessions.session = requests.Session()
+    return sessions.session
+
+
+def is_get_file(test_file_path):
+    with open(test_file_path, 'r') as test_file:
+        return "get_path" in json.load(test_file)
+
+
+# Start the run of GET test files beginning at step index in the pool. They only
+# read, so they can run together; url steps (create, commit, clean, ...) and post
+# files end the run and keep their place in the order.
+def start_get_files(pool, server, script_dir, json_script, index):
+    futures = {}
+    while index < len(json_script) and "file" in json_script[index]:
+        test_file_path = path.join(script_dir, json_script[index]["file"])
+        if not is_get_file(test_file_path):
+            break
+        futures[index] = pool.submit(run_test_file, server, test_file_path)
+        index += 1
+    return futures
+
+
 # Run a single file which is made up of multiple requests to the same URL
 def run_test_file(server, test_file_path, fail_on_wrong_response=True):        
     with open(test_file_path, 'r') as test_file:
@@ -62,7 +94,7 @@ def run_test_file(server, test_file_path, fail_on_wrong_response=True):
             count = 0
             post_url = "%s%s" % (server, script["post_path"])
             for v in script["values"]:
-                r = requests.post(post_url, json=v)
+                r = get_session().post(post_url, json=v)
                 if r.status_code not in response:
                     if fail_on_wrong_response:
                         body = r.content
@@ -86,7 +118,7 @@ def run_test_file(server, test_file_path, fail_on_wrong_response=True):
                 # appending parameters into get_url
                 expected = v["expected"]
 
-                r = requests.get(get_url)
+                r = get_session().get(get_url)
                 if r.status_code not in response:
                     if fail_on_wrong_response:
                         raise LoaderError("Failure (%s) on get to %s  " % (r.status_code, get_url))
@@ -133,60 +165,75 @@ def run_script(script_file, cfg):
     server = "http://%s:%s/" % (cfg.server, cfg.port)
     script_dir = path.dirname(script_file)
     failed = False
-    with open(script_file, 'r') as file_in:
-        if cfg.out:
-            out_file = open(cfg.out,'w')
-        json_script = json.load(file_in)
-        for script in json_script:
-            if "url" in script:
-                get_url = "%s%s" %(server,script["url"])
-                r = requests.get(get_url)
-                if r.status_code != script["response"]:
-                    if cfg.out:
-                        out_file.write("get-%s FAILED\n"% get_url)                        
-                    if cfg.nofailfast:
-                        print("Failure on %s. Expected %s Got %s" % (get_url, script["response"], r.status_code))
-                        failed = True
+    # GET test files started ahead in the pool, by step index
+    pool = ThreadPoolExecutor(cfg.parallel) if cfg.parallel > 1 else None
+    pending = {}
+    try:
+        with open(script_file, 'r') as file_in:
+            if cfg.out:
+                out_file = open(cfg.out,'w')
+            json_script = json.load(file_in)
+            for i, script in enumerate(json_script):
+                if "url" in script:
+                    get_url = "%s%s" %(server,script["url"])
+                    r = get_session().get(get_url)
+                    if r.status_code != script["response"]:
+                        if cfg.out:
+                            out_file.write("get-%s FAILED\n"% get_url)                        
+                        if cfg.nofailfast:
+                            print("Failure on %s. Expected %s Got %s" % (get_url, script["response"], r.status_code))
+                            failed = True
+                        else:
+                            if cfg.concat and not cfg.nofailfast:
+                                with open(cfg.concat,"a") as of:
+                                    of.write("test %s FAILED\n" % cfg.name )
+                            raise LoaderError("Failure on %s. Expected %s Got %s" % (get_url, script["response"], r.status_code))
                     else:
-                        if cfg.concat and not cfg.nofailfast:
-                            with open(cfg.concat,"a") as of:
-                                of.write("test %s FAILED\n" % cfg.name )
-                        raise LoaderError("Failure on %s. Expected %s Got %s" % (get_url, script["response"], r.status_code))
+                        print("Called %s" % get_url)
+                        if "body" in script:
+                            if r.text == script["body"]:
+                                if cfg.out:
+                                    out_file.write("get-%s ok\n"% get_url)
+                            else:                           
+                                err_msg = "Failure on %s. Expected %s Got %s" % (get_url, script["body"], r.text)
+                                if cfg.nofailfast:
+                                    print(err_msg)
+                                    failed = True
+                                else:
+                                    if cfg.concat and not cfg.nofailfast:
+                                        with open(cfg.concat,"a") as of:
+                                            of.write("test %s FAILED\n" % cfg.name )
+                                    raise LoaderError(err_msg)                       
+                        elif cfg.out:
+                            out_file.write("get-%s ok\n"% get_url)
                 else:
-                    print("Called %s" % get_url)
-                    if "body" in script:
-                        if r.text == script["body"]:
-                            if cfg.out:
-                                out_file.write("get-%s ok\n"% get_url)
-                        else:                           
-                            err_msg = "Failure on %s. Expected %s Got %s" % (get_url, script["body"], r.text)
-                            if cfg.nofailfast:
-                                print(err_msg)
-                                failed = True
-                            else:
-                                if cfg.concat and not cfg.nofailfast:
-                                    with open(cfg.concat,"a") as of:
-                                        of.write("test %s FAILED\n" % cfg.name )
-                                raise LoaderError(err_msg)                       
-                    elif cfg.out:
-                        out_file.write("get-%s ok\n"% get_url)
-            else:
-                try:
-                    count = run_test_file(server, path.join(script_dir, script["file"]))
-                    print("Ran file %s Successful %s" % (script["file"], count))
-                    if cfg.out:
-                        out_file.write("%s ok\n"% script["file"])                    
-                except LoaderError as le:
-                    if cfg.out:
-                        out_file.write("%s FAILED\n"% script["file"])
-                    if cfg.nofailfast:
-                        print(le.message)
-                        failed = True
-                    else:
-                        if cfg.concat and not cfg.nofailfast:
-                            with open(cfg.concat,"a") as of:
-                                of.write("test %s FAILED\n" % cfg.name )
-                        raise le
+                    try:
+                        if pool is not None and i not in pending:
+                            pending.update(start_get_files(pool, server, script_dir, json_script, i))
+                        if i in pending:
+                            count = pending.pop(i).result()
+                        else:
+                            count = run_test_file(server, path.join(script_dir, script["file"]))
+                        print("Ran file %s Successful %s" % (script["file"], count))
+                        if cfg.out:
+                            out_file.write("%s ok\n"% script["file"])                    
+                    except LoaderError as le:
+                        if cfg.out:
+                            out_file.write("%s FAILED\n"% script["file"])
+                        if cfg.nofailfast:
+                            print(le.message)
+                            failed = True
+                        else:
+                            if cfg.concat and not cfg.nofailfast:
+                                with open(cfg.concat,"a") as of:
+                                    of.write("test %s FAILED\n" % cfg.name )
+                            raise le
+    finally:
+        if pool is not None:
+            # on a failure GET files started ahead but not yet running are dropped, not sent
+            for future in pending.values():
+                future.cancel()
+            pool.shutdown()
     print("Done")
     if cfg.concat:
         with open(cfg.concat,"a") as of:
@@ -203,6 +250,7 @@ if __name__ == "__main__":
     parser.add_argument("-p", "--port", help="Server port (default 30235)", default=30235, type=int)
     parser.add_argument("-i", "--indent", help="indent compare output (default False)", default=False, action="store_true")
     parser.add_argument("-nff", "--nofailfast", help="No fail fast (stop test on first failure)", default=False, action="store_true")
+    parser.add_argument("-j", "--parallel", help="Run consecutive GET test files on this many threads (default 1). The Flask dev server handles one request at a time, so against it this adds no throughput", default=1, type=int)
     parser.add_argument("-o", "--out", help="Write out test results to file (staff only)", )
     parser.add_argument("-c", "--concat", help="Concat out final result to this file  (staff only)")
     parser.add_argument("-n", "--name", help="Concat out final result as this name. Default to file name (staff only)")
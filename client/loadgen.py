@@ -0,0 +1,236 @@
+"""
+Load generator. Replays the requests of a client.py script (its "url" steps and
+the post_path/values and get_path/tests files it lists) from several worker
+threads for a fixed duration, optionally at a target request rate, and reports
+throughput, latency percentiles and error rates per endpoint.
+
+Responses are only checked against the expected status codes, not bodies.
+Steps that change server state wholesale (create, reset, seed, clean, txn,
+commit, abort) are left out of the load unless --include-admin is given; run
+the script once with --prepare to load the data the reads need. The server
+rejects inspections it already has, so once the workload wraps around, POSTs
+of the same values are reported as errors of their endpoint. The Flask dev
+server handles one request at a time, so against it more workers only queue up
+and show as latency, not throughput.
+
+    python loadgen.py -f ../data/ms2-100/full.json --prepare -c 8 -d 30 --rate 500
+"""
+import argparse
+import itertools
+import json
+import threading
+import time
+from os import path
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from client import LoaderError, validate_script
+
+# First path segment of script steps that reset or rewrite the whole database
+ADMIN_STEPS = {"create", "reset", "seed", "clean", "txn", "commit", "abort"}
+
+PERCENTILES = (50, 95, 99)
+
+
+class Request:
+    """
+    One request of the workload and the endpoint it is reported under.
+    """
+    __slots__ = ("method", "url", "json", "expected", "endpoint")
+
+    def __init__(self, method, url, json, expected, endpoint):
+        self.method = method
+        self.url = url
+        self.json = json
+        self.expected = expected
+        self.endpoint = endpoint
+
+
+def load_requests(script_file, server):
+    """
+    Returns every request of a script in order, with whether it is an admin step.
+    """
+    script_dir = path.dirname(script_file)
+    with open(script_file, "r") as file_in:
+        steps = json.load(file_in)
+    workload = []
+    for step in steps:
+        if "url" in step:
+            endpoint = step["url"].split("/")[0]
+            workload.append((Request("GET", server + step["url"], None, [step["response"]], "GET /" + endpoint),
+                             endpoint in ADMIN_STEPS))
+            continue
+        with open(path.join(script_dir, step["file"]), "r") as test_file:
+            test = json.load(test_file)
+        expected = test["response"] if isinstance(test["response"], list) else [test["response"]]
+        if "post_path" in test:
+            for value in test["values"]:
+                workload.append((Request("POST", server + test["post_path"], value, expected,
+                                         "POST /" + test["post_path"]), False))
+        else:
+            for t in test["tests"]:
+                url = server + test["get_path"]
+                endpoint = "GET /" + test["get_path"]
+                if "inputs" in t:
+                    url = "%s/%s" % (url, t["inputs"])
+                    endpoint += "/<input>"
+                workload.append((Request("GET", url, None, expected, endpoint), False))
+    return workload
+
+
+def make_session():
+    # a worker's connection is reused when the server keeps it open; the
+    # single-threaded Flask dev server answers HTTP/1.0 and closes every one
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def send(session, request, timeout):
+    """
+    Returns whether the request got one of its expected status codes.
+    """
+    try:
+        r = session.request(request.method, request.url, json=request.json, timeout=timeout)
+        r.content  # read the body so a kept-alive connection can be reused
+        return r.status_code in request.expected
+    except RequestException:
+        return False
+
+
+def prepare(workload, timeout):
+    # the whole script once, in order, admin steps included
+    session = make_session()
+    for request, _ in workload:
+        if not send(session, request, timeout):
+            raise LoaderError("Prepare failed on %s %s" % (request.method, request.url))
+    session.close()
+
+
+class LoadRun:
+    """
+    Workers take the next request of the cycled workload until the duration is
+    over. With a rate, request i is due at start + i / rate and its latency is
+    measured from then, so a server falling behind shows up in the latencies
+    instead of silently lowering the rate.
+    """
+    def __init__(self, requests, concurrency, duration, rate=None, timeout=30):
+        self.requests = itertools.cycle(requests)
+        self.concurrency = concurrency
+        self.duration = duration
+        self.rate = rate
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.results = {}  # endpoint -> (latencies, errors)
+
+    def next_request(self):
+        with self.lock:
+            due = self.start + self.sent / self.rate if self.rate else None
+            self.sent += 1
+            return next(self.requests), due
+
+    def worker(self):
+        session = make_session()
+        latencies = {}
+        errors = {}
+        while True:
+            request, due = self.next_request()
+            now = time.perf_counter()
+            if due is not None and due > now:
+                if due >= self.end:
+                    break
+                time.sleep(due - now)
+            elif now >= self.end:
+                break
+            start = due if due is not None else time.perf_counter()
+            ok = send(session, request, self.timeout)
+            latencies.setdefault(request.endpoint, []).append(time.perf_counter() - start)
+            if not ok:
+                errors[request.endpoint] = errors.get(request.endpoint, 0) + 1
+        session.close()
+        with self.lock:
+            for endpoint, values in latencies.items():
+                all_latencies, all_errors = self.results.get(endpoint, ([], 0))
+                self.results[endpoint] = (all_latencies + values, all_errors + errors.get(endpoint, 0))
+
+    def run(self):
+        self.start = time.perf_counter()
+        self.end = self.start + self.duration
+        workers = [threading.Thread(target=self.worker) for _ in range(self.concurrency)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        self.elapsed = time.perf_counter() - self.start
+        return self.report()
+
+    def report(self):
+        rows = [summarize(endpoint, latencies, errors, self.elapsed)
+                for endpoint, (latencies, errors) in sorted(self.results.items())]
+        total = summarize("total", [l for latencies, _ in self.results.values() for l in latencies],
+                          sum(errors for _, errors in self.results.values()), self.elapsed)
+        return {"seconds": round(self.elapsed, 3), "concurrency": self.concurrency, "rate": self.rate,
+                "endpoints": rows, "total": total}
+
+
+def percentile(values, p):
+    # nearest rank on sorted values
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+def summarize(endpoint, latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    row = {"endpoint": endpoint, "requests": len(latencies), "errors": errors,
+           "error_rate": round(errors / len(latencies), 4) if latencies else 0.0,
+           "throughput": round(len(latencies) / elapsed, 1) if elapsed else 0.0}
+    for p in PERCENTILES:
+        row["p%d_ms" % p] = round(percentile(latencies, p) * 1000, 2) if latencies else None
+    row["max_ms"] = round(latencies[-1] * 1000, 2) if latencies else None
+    return row
+
+
+def print_report(report):
+    print("%-40s %9s %7s %7s %9s %9s %9s %9s %9s" % ("endpoint", "requests", "errors", "err%", "req/s",
+                                                    "p50 ms", "p95 ms", "p99 ms", "max ms"))
+    for row in report["endpoints"] + [report["total"]]:
+        print("%-40s %9d %7d %6.2f%% %9.1f %9s %9s %9s %9s" % (
+            row["endpoint"], row["requests"], row["errors"], row["error_rate"] * 100, row["throughput"],
+            row["p50_ms"], row["p95_ms"], row["p99_ms"], row["max_ms"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a client script as concurrent load")
+    parser.add_argument("-f", "--file", dest="file", help="Input json script file", required=True)
+    parser.add_argument("-s", "--server", help="Server hostname (default localhost)", default="127.0.0.1")
+    parser.add_argument("-p", "--port", help="Server port (default 30235)", default=30235, type=int)
+    parser.add_argument("-c", "--concurrency", help="Worker threads, each with its own session (default 4)",
+                        default=4, type=int)
+    parser.add_argument("-d", "--duration", help="Seconds to run the load for (default 10)", default=10, type=float)
+    parser.add_argument("-r", "--rate", help="Target requests per second over all workers (default as fast as possible)",
+                        default=None, type=float)
+    parser.add_argument("--timeout", help="Request timeout in seconds (default 30)", default=30, type=float)
+    parser.add_argument("--prepare", help="Run the whole script once in order before the load", default=False,
+                        action="store_true")
+    parser.add_argument("--include-admin", help="Also replay create/reset/seed/clean/txn/commit/abort steps",
+                        default=False, action="store_true")
+    parser.add_argument("-o", "--out", help="Also write the report as JSON to this file")
+    config = parser.parse_args()
+
+    try:
+        validate_script(config.file)
+        workload = load_requests(config.file, "http://%s:%s/" % (config.server, config.port))
+        if config.prepare:
+            prepare(workload, config.timeout)
+        load = [request for request, admin in workload if config.include_admin or not admin]
+        if not load:
+            raise LoaderError("No requests to replay in %s" % config.file)
+        report = LoadRun(load, config.concurrency, config.duration, config.rate, config.timeout).run()
+        print_report(report)
+        if config.out:
+            with open(config.out, "w") as out_file:
+                json.dump(report, out_file, indent=1)
+    except LoaderError as e:
+        print("LoaderError: %s" % e.message)
@@ -0,0 +1,362 @@
+"""
+Blocking strategies used when cleaning restaurants. A blocker groups the dirty
+restaurants into blocks and only records that share a block are compared, which
+trades recall (duplicates split across blocks are missed) against runtime.
+"""
+import argparse
+import json
+import math
+import sqlite3
+from abc import ABC, abstractmethod
+from collections import Counter
+from matching import Matcher, RestaurantRecord, RECORD_COLUMNS, to_records
+from normalize import normalize_restaurant
+
+
+def size_histogram(sizes):
+    """
+    Buckets block sizes by powers of two, e.g. {"1": 10, "2-3": 4, "4-7": 2, "8-15": 1}.
+    """
+    histogram = Counter()
+    for size in sizes:
+        low = 1
+        while low * 2 <= size:
+            low *= 2
+        high = low * 2 - 1
+        histogram[str(low) if low == high else "%d-%d" % (low, high)] += 1
+    return dict(sorted(histogram.items(), key=lambda item: int(item[0].split("-")[0])))
+
+
+def pairs_in(size):
+    return size * (size - 1) // 2
+
+
+def street_number(address):
+    # leading house number of an address, e.g. "1909" for "1909 N LINCOLN AVE"
+    number = ""
+    for ch in (address or "").strip():
+        if not ch.isdigit():
+            break
+        number += ch
+    return number
+
+
+# Key functions usable by KeyBlocker, over the normalized columns (see normalize.py)
+def zip_name_key(restaurant):
+    # the original blocker: first five characters of zip plus first character of name
+    return (restaurant.zip or "")[:5], (restaurant.name_norm or "")[:1]
+
+def zip_street_number_key(restaurant):
+    return (restaurant.zip or "")[:5], street_number(restaurant.address_norm)
+
+def name_street_number_key(restaurant):
+    return (restaurant.name_norm or "").replace(" ", "")[:4], street_number(restaurant.address_norm)
+
+
+# Secondary keys split_block uses on oversized blocks. Each key is tried on what
+# the previous one left too large.
+def street_number_prefix_key(restaurant):
+    # all but the last digit, so 1000 and 1004 stay together
+    number = street_number(restaurant.address_norm)
+    return number[:max(len(number) - 1, 1)]
+
+def name_prefix_key(restaurant):
+    return (restaurant.name_norm or "").replace(" ", "")[:3]
+
+# Size of a geo grid cell in degrees, about 200m north-south in Chicago
+GEO_GRID_SIZE = 0.002
+
+def geo_grid_key(restaurant):
+    try:
+        return (math.floor(float(restaurant.latitude) / GEO_GRID_SIZE),
+                math.floor(float(restaurant.longitude) / GEO_GRID_SIZE))
+    except (TypeError, ValueError):
+        return None
+
+SPLIT_KEYS = (street_number_prefix_key, name_prefix_key, geo_grid_key)
+
+
+def chunk_order_key(restaurant):
+    return (restaurant.name_norm or "", restaurant.address_norm or "", restaurant.id)
+
+def split_block(records, max_size, keys=SPLIT_KEYS):
+    """
+    Splits a block of more than max_size records by the first of keys that
+    divides it, recursing with the remaining keys into sub-blocks that are still
+    too large. What no key divides (e.g. many records with the same name, address
+    and location) is sorted by name and address and cut into chunks of max_size,
+    so no sub-block is ever larger than max_size. Records are only ever compared
+    within a sub-block, so splitting trades recall for a bounded block.
+    """
+    if len(records) <= max_size:
+        return [records]
+    if not keys:
+        ordered = sorted(records, key=chunk_order_key)
+        return [ordered[i:i + max_size] for i in range(0, len(ordered), max_size)]
+    groups = {}
+    for restaurant in records:
+        groups.setdefault(keys[0](restaurant), []).append(restaurant)
+    if len(groups) == 1:
+        return split_block(records, max_size, keys[1:])
+    sub_blocks = []
+    for group in groups.values():
+        sub_blocks.extend(split_block(group, max_size, keys[1:]))
+    return sub_blocks
+
+
+class Blocker(ABC):
+    """
+    Base class for blockers. Subclasses implement candidate_pairs(), which
+    returns the id pairs to score and records stats about block sizes and pair
+    counts in self.stats.
+    """
+    name = "blocker"
+
+    def __init__(self):
+        self.stats = {}
+
+    @abstractmethod
+    def candidate_pairs(self, restaurants):
+        """
+        Returns a set of (smaller id, larger id) pairs to compare.
+        """
+
+
+def block_pairs(blocker, restaurants, blocks):
+    """
+    Returns every pair of ids that share one of blocks (lists of restaurants),
+    setting blocker.stats from the block sizes.
+    """
+    pairs = set()
+    sizes = []
+    for block in blocks:
+        sizes.append(len(block))
+        ids = sorted(r.id for r in block)
+        for i in range(len(ids)):
+            for j in range(i + 1, len(ids)):
+                pairs.add((ids[i], ids[j]))
+    blocker.stats = {
+        "blocker": blocker.name,
+        "restaurants": len(restaurants),
+        "blocks": len(sizes),
+        "largest_block": max(sizes, default=0),
+        "block_size_histogram": size_histogram(sizes),
+        "candidate_pairs": len(pairs),
+    }
+    return pairs
+
+
+class KeyBlocker(Blocker):
+    """
+    Exact blocking: restaurants with equal key_func values share a block.
+    """
+    def __init__(self, key_func=zip_name_key, name="prefix"):
+        Blocker.__init__(self)
+        self.key_func = key_func
+        self.name = name
+
+    def blocks(self, restaurants):
+        blocks = {}
+        for restaurant in restaurants:
+            blocks.setdefault(self.key_func(restaurant), []).append(restaurant)
+        return blocks.values()
+
+    def candidate_pairs(self, restaurants):
+        return block_pairs(self, restaurants, self.blocks(restaurants))
+
+
+class SortedNeighbourhoodBlocker(Blocker):
+    """
+    Sorts restaurants on the normalized address + name and compares each record
+    with the next window - 1 records, so a typo in the first letter of a name
+    does not put duplicates in different blocks as long as the address agrees.
+    """
+    name = "sorted"
+
+    def __init__(self, window=5):
+        Blocker.__init__(self)
+        self.window = window
+
+    def sort_key(self, restaurant):
+        return (restaurant.address_norm or "") + " " + (restaurant.name_norm or "")
+
+    def blocks(self, restaurants):
+        ordered = sorted(restaurants, key=lambda r: (self.sort_key(r), r.id))
+        if len(ordered) <= self.window:
+            return [ordered] if ordered else []
+        return [ordered[i:i + self.window] for i in range(len(ordered) - self.window + 1)]
+
+    def candidate_pairs(self, restaurants):
+        return block_pairs(self, restaurants, self.blocks(restaurants))
+
+
+class MultiPassBlocker(Blocker):
+    """
+    Unions the candidate pairs of several blockers. Stats for each pass are
+    reported under "passes".
+    """
+    name = "multipass"
+
+    def __init__(self, blockers=None):
+        Blocker.__init__(self)
+        if blockers is None:
+            blockers = [KeyBlocker(zip_name_key, "zip_name"),
+                        KeyBlocker(zip_street_number_key, "zip_street_number"),
+                        KeyBlocker(name_street_number_key, "name_street_number")]
+        self.blockers = blockers
+
+    def candidate_pairs(self, restaurants):
+        pairs = set()
+        passes = []
+        for blocker in self.blockers:
+            pairs |= blocker.candidate_pairs(restaurants)
+            passes.append(blocker.stats)
+        self.stats = {
+            "blocker": self.name,
+            "restaurants": len(restaurants),
+            "blocks": sum(p["blocks"] for p in passes),
+            "largest_block": max((p["largest_block"] for p in passes), default=0),
+            "candidate_pairs": len(pairs),
+            "passes": passes,
+        }
+        return pairs
+
+
+def qgrams(value, q=3):
+    # overlapping q-grams of a normalized value, padded so short strings still get tokens
+    if not value:
+        return set()
+    padded = "#" * (q - 1) + value + "#" * (q - 1)
+    return {padded[i:i + q] for i in range(len(padded) - q + 1)}
+
+
+class QGramBlocker(Blocker):
+    """
+    Candidate generation from an inverted index over q-grams of name and address.
+    A pair is proposed when the records share at least min_overlap of the smaller
+    record's q-grams, so a typo in the first letter of the name or a dirty zip does
+    not stop duplicates from being compared. Q-grams that occur in more than
+    max_posting records carry little signal and are skipped to keep the index
+    from degenerating into an all-pairs scan.
+    """
+    name = "qgram"
+
+    def __init__(self, q=3, min_overlap=0.3, max_posting=500):
+        Blocker.__init__(self)
+        self.q = q
+        self.min_overlap = min_overlap
+        self.max_posting = max_posting
+
+    def tokens(self, restaurant):
+        return ({"N" + g for g in qgrams(restaurant.name_norm, self.q)} |
+                {"A" + g for g in qgrams(restaurant.address_norm, self.q)})
+
+    def candidate_pairs(self, restaurants):
+        tokens = {}
+        index = {}
+        for restaurant in restaurants:
+            tokens[restaurant.id] = self.tokens(restaurant)
+            for token in tokens[restaurant.id]:
+                index.setdefault(token, []).append(restaurant.id)
+
+        skipped = [token for token, posting in index.items() if len(posting) > self.max_posting]
+        for token in skipped:
+            del index[token]
+
+        pairs = set()
+        for restaurant in restaurants:
+            rid = restaurant.id
+            shared = Counter()
+            for token in tokens[rid]:
+                for other in index.get(token, ()):
+                    if other > rid:
+                        shared[other] += 1
+            for other, count in shared.items():
+                smaller = min(len(tokens[rid]), len(tokens[other]))
+                if smaller and count >= self.min_overlap * smaller:
+                    pairs.add((rid, other))
+
+        posting_sizes = [len(posting) for posting in index.values()]
+        self.stats = {
+            "blocker": self.name,
+            "restaurants": len(restaurants),
+            "blocks": len(posting_sizes),
+            "largest_block": max(posting_sizes, default=0),
+            "block_size_histogram": size_histogram(posting_sizes),
+            "skipped_tokens": len(skipped),
+            "candidate_pairs": len(pairs),
+        }
+        return pairs
+
+
+def compare_blockers(restaurants, blockers):
+    """
+    Measures each blocker against the matches found by scoring every pair. Returns
+    one row per blocker with the pairs it compares, the true matches among them,
+    recall and the fraction of the all-pairs comparisons it avoids.
+    """
+    matcher = Matcher()
+    all_pairs = pairs_in(len(restaurants))
+    true_matches = set()
+    for i, restaurant in enumerate(restaurants):
+        for match in restaurants[i + 1:]:
+            if matcher.is_match(restaurant, match):
+                true_matches.add((min(restaurant.id, match.id), max(restaurant.id, match.id)))
+
+    rows = []
+    for blocker in blockers:
+        pairs = blocker.candidate_pairs(restaurants)
+        found = len(pairs & true_matches)
+        rows.append({
+            "blocker": blocker.name,
+            "candidate_pairs": len(pairs),
+            "true_matches": len(true_matches),
+            "matches_found": found,
+            "recall": round(found / len(true_matches), 4) if true_matches else 1.0,
+            "reduction_ratio": round(1 - len(pairs) / all_pairs, 4) if all_pairs else 0.0,
+        })
+    return rows
+
+
+BLOCKERS = {
+    "prefix": KeyBlocker,
+    "sorted": SortedNeighbourhoodBlocker,
+    "multipass": MultiPassBlocker,
+    "qgram": QGramBlocker,
+}
+
+def make_blocker(name):
+    """
+    Creates a blocker by the name used on the server command line.
+    """
+    if name not in BLOCKERS:
+        raise ValueError("Unknown blocker %s" % name)
+    return BLOCKERS[name]()
+
+
+def load_restaurants(args):
+    # restaurants from a client test file (post_path/values) or from an insp.db
+    if args.file:
+        with open(args.file, "r") as test_file:
+            values = json.load(test_file)["values"]
+        restaurants = []
+        for i, v in enumerate(values):
+            name_norm, address_norm, city_norm = normalize_restaurant(v)
+            restaurants.append(RestaurantRecord.from_dict(dict(v, id=i + 1, name_norm=name_norm, address_norm=address_norm,
+                                                               city_norm=city_norm)))
+        return restaurants
+    conn = sqlite3.connect(args.db)
+    return to_records(conn.execute("SELECT %s FROM ri_restaurants ORDER BY id" % RECORD_COLUMNS))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare recall and pairs compared of the blockers")
+    parser.add_argument("-f", "--file", help="Client test file with restaurant values, e.g. ../data/ms3/chiDirty100.json")
+    parser.add_argument("-d", "--db", help="SQLite database to read ri_restaurants from (default insp.db)", default="insp.db")
+    args = parser.parse_args()
+
+    restaurants = load_restaurants(args)
+    print("%-10s %12s %8s %8s %10s" % ("blocker", "pairs", "found", "recall", "reduction"))
+    for row in compare_blockers(restaurants, [make_blocker(name) for name in BLOCKERS]):
+        print("%-10s %12d %8d %8.4f %10.4f" % (row["blocker"], row["candidate_pairs"], row["matches_found"],
+                                                row["recall"], row["reduction_ratio"]))
@@ -1,9 +1,45 @@
 from os import path
 import logging # Logging Library
 from errors import KeyNotFound, BadRequest, InspError
-from datetime import datetime
+from datetime import datetime, timedelta
+import math
 import string
-import jellyfish
+import time
+from blocking import zip_name_key, size_histogram, pairs_in, split_block
+from matching import Matcher, UnionFind, RestaurantRecord, RECORD_COLUMNS, to_records
+from normalize import normalize_name, normalize_restaurant
+from violations import parse_violations, format_violations, pack_comments, unpack_comments
+
+# Restaurant attributes returned by the API (ri_restaurants also holds normalized copies)
+RESTAURANT_COLUMNS = "id, name, facility_type, address, city, state, zip, latitude, longitude, clean"
+
+# Rows fetched at a time when streaming a large result set
+STREAM_BATCH_SIZE = 1000
+
+# inspection_date is stored as an ISO date (YYYY-MM-DD) and returned in the
+# "YYYY-MM-DD 00:00:00" form the API has always used
+INSPECTION_DATE = "datetime(inspection_date) AS inspection_date"
+
+# Mean earth radius in meters, for distances between restaurants
+EARTH_RADIUS_M = 6371008.8
+
+# Inspection results counted separately in ri_inspection_rollup
+ROLLUP_RESULTS = {"Pass": "passed", "Fail": "failed", "Pass w/ Conditions": "conditional"}
+
+# Columns /stats can group the rollup by
+ROLLUP_GROUPS = ["zip", "facility_type", "month"]
+
+# Adds counts to a rollup row, creating it on first use
+ROLLUP_UPSERT = """ON CONFLICT (zip, facility_type, month) DO UPDATE SET
+                       inspections = inspections + excluded.inspections,
+                       passed = passed + excluded.passed,
+                       failed = failed + excluded.failed,
+                       conditional = conditional + excluded.conditional"""
+
+# Columns of an export row: an inspection together with its restaurant
+EXPORT_COLUMNS = ["seq", "id", "risk", "inspection_date", "inspection_type", "results", "violations",
+                  "restaurant_id", "name", "facility_type", "address", "city", "state", "zip",
+                  "latitude", "longitude", "clean"]
 
 # Utility factor to allow results to be used like a dictionary
 def dict_factory(cursor, row):
@@ -65,7 +101,7 @@ class DB:
             raise InspError("No Restaurant Id", 404)
         # TODO milestone 1
         c = self.conn.cursor() # ? placeholder is used to bind data to the query
-        c.execute("select * from ri_restaurants where id = ?", (restaurant_id,))
+        c.execute("select %s from ri_restaurants where id = ?" % RESTAURANT_COLUMNS, (restaurant_id,))
         res = to_json_list(c)
         self.conn.commit()
         if res == None:
@@ -85,7 +121,7 @@ class DB:
         """
         # TODO milestone 1
         c = self.conn.cursor()
-        c.execute("select * from ri_restaurants where id in (select restaurant_id from ri_inspections where id = ?)", (inspection_id,))
+        c.execute("select %s from ri_restaurants where id in (select restaurant_id from ri_inspections where id = ?)" % RESTAURANT_COLUMNS, (inspection_id,))
         res = to_json_list(c)
         self.conn.commit()
         if not res:
@@ -108,7 +144,7 @@ class DB:
         c.execute(primary, (inspection_id,))
         primary_id = c.fetchone()[0]
        
-        c.execute("""SELECT * FROM ri_restaurants WHERE id = ?""", (primary_id,))
+        c.execute("""SELECT %s FROM ri_restaurants WHERE id = ?""" % RESTAURANT_COLUMNS, (primary_id,))
         primary_rest = to_json_list(c)[0]
 
         # has not been cleaned
@@ -122,7 +158,7 @@ class DB:
             ids.append(id[0])
         
         questionmarks = ['?'] * len(ids)
-        matchID = """SELECT * FROM ri_restaurants WHERE id in (%s) order by id""" % (",").join(questionmarks)
+        matchID = """SELECT %s FROM ri_restaurants WHERE id in (%s) order by id""" % (RESTAURANT_COLUMNS, (",").join(questionmarks))
         c.execute(matchID, ids)
         linked_rests = to_json_list(c)
         ids.append(primary_id)
@@ -141,17 +177,20 @@ class DB:
         httpResponseCode = 200
         return res, httpResponseCode
 
-    def find_inspections(self, restaurant_id):
+    def find_inspections(self, restaurant_id, comments=True):
         """
         Searches for all inspections associated with the given restaurant.
         Returns an empty list if no matching inspections are found.
+        With comments=False the violations are returned without their comments,
+        which are then neither read nor decompressed.
         """
         if not restaurant_id:
             raise InspError("Not Restaurant Id", 404)
         # TODO milestone 1
         c = self.conn.cursor()
-        c.execute("select id, risk, inspection_date, inspection_type, results, violations from ri_inspections where restaurant_id = ? order by id", (restaurant_id,))
+        c.execute("select id, risk, %s, inspection_type, results, violations from ri_inspections where restaurant_id = ? order by id" % INSPECTION_DATE, (restaurant_id,))
         res = to_json_list(c) # fetchall() returns [] if the output of execute() is empty
+        self.attach_violations(res, comments)
         self.conn.commit()
         if len(res) == 0:
             return None
@@ -159,11 +198,235 @@ class DB:
             return res
     
 
-    def add_inspection_for_restaurant(self, inspection, restaurant):
+    def stream_inspections(self, start=None, end=None, result=None, comments=True):
+        """
+        Yields batches of the inspections dated from start to end (inclusive
+        datetime.date bounds, either may be None) ordered by date, optionally
+        only those with the given result. The range is read from the
+        (inspection_date, restaurant_id) index.
+        """
+        conditions = []
+        params = []
+        if start is not None:
+            conditions.append("inspection_date >= ?")
+            params.append(start.isoformat())
+        if end is not None:
+            # exclusive upper bound, so dates stored with a time still match
+            conditions.append("inspection_date < ?")
+            params.append((end + timedelta(days=1)).isoformat())
+        if result is not None:
+            conditions.append("results = ?")
+            params.append(result)
+        query = """SELECT id, risk, %s, inspection_type, results, violations, restaurant_id
+                   FROM ri_inspections %s ORDER BY inspection_date, restaurant_id""" % (
+                       INSPECTION_DATE, "WHERE " + " AND ".join(conditions) if conditions else "")
+        c = self.conn.cursor()
+        c.execute(query, params)
+        headers = [d[0] for d in c.description]
+        rows = c.fetchmany(STREAM_BATCH_SIZE)
+        while rows:
+            batch = [dict(zip(headers, row)) for row in rows]
+            self.attach_violations(batch, comments)
+            yield batch
+            rows = c.fetchmany(STREAM_BATCH_SIZE)
+
+    def find_changes(self, after=0, limit=100):
+        """
+        Returns up to limit entries of the change feed with a seq above after,
+        oldest first.
+        """
+        c = self.conn.cursor()
+        c.execute("""SELECT seq, kind, item_id, restaurant_id, detail, changed_at FROM ri_changes
+                     WHERE seq > ? ORDER BY seq LIMIT ?""", (after, limit))
+        res = to_json_list(c)
+        self.conn.commit()
+        return res
+
+    def add_to_rollup(self, restaurant_id, inspection_date, results):
+        # counts a new inspection under its restaurant's zip and facility type
+        c = self.conn.cursor()
+        c.execute("""INSERT INTO ri_inspection_rollup (zip, facility_type, month, inspections, passed, failed, conditional)
+                     SELECT coalesce(zip, ''), coalesce(facility_type, ''), ?, 1, ?, ?, ?
+                     FROM ri_restaurants WHERE id = ? """ + ROLLUP_UPSERT,
+                  (inspection_date[:7],) + rollup_counts(results)[1:] + (restaurant_id,))
+
+    def find_stats(self, group_by=ROLLUP_GROUPS, zip=None, facility_type=None, start_month=None, end_month=None):
+        """
+        Sums ri_inspection_rollup by the group_by columns (a subset of
+        ROLLUP_GROUPS), optionally for one zip and facility type and a range of
+        YYYY-MM months, and adds the pass, fail and conditional rates.
+        """
+        conditions = []
+        params = []
+        for condition, value in (("zip = ?", zip), ("facility_type = ?", facility_type),
+                                 ("month >= ?", start_month), ("month <= ?", end_month)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        columns = ", ".join(group_by)
+        c = self.conn.cursor()
+        c.execute("""SELECT %s sum(inspections) AS inspections, sum(passed) AS passed,
+                            sum(failed) AS failed, sum(conditional) AS conditional
+                     FROM ri_inspection_rollup %s %s""" % (
+                         columns + "," if group_by else "",
+                         "WHERE " + " AND ".join(conditions) if conditions else "",
+                         "GROUP BY %s ORDER BY %s" % (columns, columns) if group_by else ""),
+                  params)
+        res = [add_rollup_rates(row) for row in to_json_list(c) if row["inspections"]]
+        self.conn.commit()
+        return res
+
+    def rebuild_rollup(self):
+        """
+        Recomputes ri_inspection_rollup from ri_inspections, for data loaded
+        without add_inspection_for_restaurant.
+        """
+        c = self.conn.cursor()
+        c.execute("DELETE FROM ri_inspection_rollup")
+        c.execute("""INSERT INTO ri_inspection_rollup (zip, facility_type, month, inspections, passed, failed, conditional)
+                     SELECT coalesce(r.zip, ''), coalesce(r.facility_type, ''), substr(i.inspection_date, 1, 7), count(*),
+                            sum(i.results = 'Pass'), sum(i.results = 'Fail'), sum(i.results = 'Pass w/ Conditions')
+                     FROM ri_inspections i JOIN ri_restaurants r ON r.id = i.restaurant_id
+                     GROUP BY 1, 2, 3""")
+        self.conn.commit()
+
+    def find_restaurants_near(self, lat, long, radius, limit):
+        """
+        Returns up to limit restaurants within radius meters of (lat, long),
+        nearest first, each with its distance in meters. Restaurants linked into
+        another one by cleaning are left out, so every cluster shows up once.
+        """
+        dlat = math.degrees(radius / EARTH_RADIUS_M)
+        dlong = dlat / max(math.cos(math.radians(lat)), 0.01)
+        c = self.conn.cursor()
+        c.execute("""SELECT %s FROM ri_restaurants_geo g JOIN ri_restaurants r ON r.id = g.id
+                     WHERE g.min_lat <= ? AND g.max_lat >= ? AND g.min_long <= ? AND g.max_long >= ?
+                     AND NOT EXISTS (SELECT 1 FROM ri_linked l
+                                     WHERE l.original_rest_id = r.id AND l.primary_rest_id != r.id)"""
+                  % ", ".join("r." + column for column in RESTAURANT_COLUMNS.split(", ")),
+                  (lat + dlat, lat - dlat, long + dlong, long - dlong))
+        res = []
+        for restaurant in to_json_list(c):
+            distance = haversine_m(lat, long, restaurant["latitude"], restaurant["longitude"])
+            if distance <= radius:
+                restaurant["distance"] = round(distance, 1)
+                res.append(restaurant)
+        self.conn.commit()
+        res.sort(key=lambda restaurant: (restaurant["distance"], restaurant["id"]))
+        return res[:limit]
+
+    def index_violations(self, inspection_seq, violations):
+        # restaurants are indexed by triggers, the violations text only exists
+        # split up in ri_violations so it is indexed as it is posted
+        if violations:
+            c = self.conn.cursor()
+            c.execute("INSERT INTO ri_violations_fts (rowid, violations) VALUES (?, ?)", (inspection_seq, violations))
+
+    def search(self, terms, limit=20, offset=0, kind=None):
+        """
+        Ranked full-text search over restaurant names and addresses ("restaurant"
+        results) and violation narratives ("inspection" results). Every term has
+        to match, words are stemmed so "rodent" also finds RODENTS. kind limits
+        the results to one of the two. Returns up to limit results from offset,
+        best bm25 rank first.
+        """
+        match = " ".join('"%s"' % term.replace('"', '""') for term in terms)
+        parts = []
+        params = []
+        if kind in (None, "restaurant"):
+            parts.append("""SELECT 'restaurant' AS type, r.id AS id, r.id AS restaurant_id, r.name AS name,
+                                   r.address AS address, NULL AS inspection_date, NULL AS results, f.rank AS rank
+                            FROM ri_restaurants_fts f JOIN ri_restaurants r ON r.id = f.rowid
+                            WHERE ri_restaurants_fts MATCH ?""")
+            params.append(match)
+        if kind in (None, "inspection"):
+            parts.append("""SELECT 'inspection' AS type, i.id AS id, i.restaurant_id AS restaurant_id, r.name AS name,
+                                   r.address AS address, datetime(i.inspection_date) AS inspection_date,
+                                   i.results AS results, f.rank AS rank
+                            FROM ri_violations_fts f JOIN ri_inspections i ON i.seq = f.rowid
+                            JOIN ri_restaurants r ON r.id = i.restaurant_id
+                            WHERE ri_violations_fts MATCH ?""")
+            params.append(match)
+        c = self.conn.cursor()
+        c.execute(" UNION ALL ".join(parts) + " ORDER BY rank LIMIT ? OFFSET ?", params + [limit, offset])
+        res = to_json_list(c)
+        self.conn.commit()
+        return res
+
+    def stream_export(self, clean=None, since=None, comments=True):
+        """
+        Yields batches of EXPORT_COLUMNS rows in the order inspections were
+        loaded. seq is the inspection's ri_inspections.seq, passing the last seq
+        seen as since continues an earlier export. clean=True or False only
+        exports the inspections of cleaned or not yet cleaned restaurants.
+        """
+        conditions = []
+        params = []
+        if clean is not None:
+            conditions.append("r.clean = ?")
+            params.append(clean)
+        if since is not None:
+            conditions.append("i.seq > ?")
+            params.append(since)
+        query = """SELECT i.seq, i.id, i.risk, datetime(i.inspection_date) AS inspection_date,
+                          i.inspection_type, i.results, i.violations, r.id AS restaurant_id, r.name,
+                          r.facility_type, r.address, r.city, r.state, r.zip, r.latitude, r.longitude, r.clean
+                   FROM ri_inspections i JOIN ri_restaurants r ON r.id = i.restaurant_id
+                   %s ORDER BY i.seq""" % ("WHERE " + " AND ".join(conditions) if conditions else "")
+        c = self.conn.cursor()
+        c.execute(query, params)
+        rows = c.fetchmany(STREAM_BATCH_SIZE)
+        while rows:
+            batch = [dict(zip(EXPORT_COLUMNS, row)) for row in rows]
+            self.attach_violations(batch, comments)
+            yield batch
+            rows = c.fetchmany(STREAM_BATCH_SIZE)
+
+    def attach_violations(self, inspections, comments=True):
+        """
+        Puts back the violations narrative of inspections whose violations were
+        split into ri_violations. Inspections kept verbatim are left as they are.
+        """
+        if not inspections:
+            return
+        by_id = {inspection["id"]: inspection for inspection in inspections}
+        questionmarks = ",".join(["?"] * len(by_id))
+        c = self.conn.cursor()
+        c.execute("""SELECT v.inspection_id, t.code, t.description, %s
+                     FROM ri_violations v JOIN ri_violation_types t ON t.id = v.type_id
+                     WHERE v.inspection_id IN (%s) ORDER BY v.inspection_id, v.seq"""
+                  % ("v.comments" if comments else "NULL", questionmarks), list(by_id))
+        items = {}
+        for inspection_id, code, description, packed in c:
+            items.setdefault(inspection_id, []).append((code, description, unpack_comments(packed)))
+        for inspection_id, violations in items.items():
+            by_id[inspection_id]["violations"] = format_violations(violations)
+
+    def add_violations(self, inspection_id, violations, compress_comments=False):
+        """
+        Splits a violations narrative into ri_violations rows. Returns the value
+        to keep in ri_inspections.violations: None when it was split, otherwise
+        the narrative itself.
+        """
+        items = parse_violations(violations)
+        if items is None:
+            return violations
+        c = self.conn.cursor()
+        rows = []
+        for seq, (code, description, comments) in enumerate(items):
+            c.execute("INSERT OR IGNORE INTO ri_violation_types (code, description) VALUES (?, ?)", (code, description))
+            c.execute("SELECT id FROM ri_violation_types WHERE code = ? AND description = ?", (code, description))
+            rows.append((inspection_id, seq, c.fetchone()[0], pack_comments(comments, compress_comments)))
+        c.executemany("INSERT INTO ri_violations (inspection_id, seq, type_id, comments) VALUES (?, ?, ?, ?)", rows)
+        return None
+
+    def add_inspection_for_restaurant(self, inspection, restaurant, compress_comments=False):
         """
         Finds or creates the restaurant then inserts the inspection and
         associates it with the restaurant. Note that the arguments 
         inspection and restaurant originate from a same post body.
+        Violations are stored with add_violations, compress_comments zlib
+        compresses their comments.
         Refer to load_inspection() and https://people.cs.uchicago.edu/~aelmore/class/30235/RestInsp.html#tag/MS1
         """
         # TODO milestone 1
@@ -184,18 +447,21 @@ class DB:
             # attributes belong to inspection
             id = inspection["inspection_id"]
             risk = inspection["risk"]
-            insDate = datetime.strptime(inspection["date"], "%m/%d/%Y")
+            insDate = datetime.strptime(inspection["date"], "%m/%d/%Y").date().isoformat()
             insType = inspection["inspection_type"]
             results = inspection["results"]
             violations = inspection["violations"]
         except KeyError as e:
             raise BadRequest(message="Required attribute is missing")
+        nameNorm, addressNorm, cityNorm = normalize_restaurant(restaurant)
         
         # match restaurant and inspection records on their names and addresses
-        matchRestaurant = """SELECT * FROM ri_restaurants WHERE name = ? AND address = ?"""
+        # (the normalized columns are indexed, the raw ones keep the match exact)
+        matchRestaurant = """SELECT * FROM ri_restaurants WHERE name_norm = ? AND address_norm = ?
+                             AND name = ? AND address = ?"""
         matchInspection = """SELECT * FROM ri_inspections WHERE id = ?"""
 
-        c.execute(matchRestaurant, (name, address))
+        c.execute(matchRestaurant, (nameNorm, addressNorm, name, address))
         resRestaurant = c.fetchone()
         c.execute(matchInspection, (id,))
         resInspection = to_json_list(c) # fetcll all the results of query and parse them into a list of dicts
@@ -204,9 +470,11 @@ class DB:
             addRestaurant = """INSERT INTO ri_restaurants
                                     (name, facility_type, address,
                                     city, state, zip,
-                                    latitude, longitude)
-                                VALUES (?, ?, ?, ?, ?, ?, ?, ?)"""
-            c.execute(addRestaurant, (name, facType, address, city, state, zip, lat, long)) # the content of cursor will change dynamically whenever the execute() runs
+                                    latitude, longitude,
+                                    name_norm, address_norm, city_norm)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+            c.execute(addRestaurant, (name, facType, address, city, state, zip, lat, long,
+                                      nameNorm, addressNorm, cityNorm)) # the content of cursor will change dynamically whenever the execute() runs
             restaurant_id = c.lastrowid # read-only attribute that provides the row id of the last inserted row.
             
             addInspection = """INSERT INTO ri_inspections
@@ -214,7 +482,10 @@ class DB:
                                     inspection_type, results,
                                     violations, restaurant_id)
                                 VALUES (?, ?, ?, ?, ?, ?, ?)"""
-            c.execute(addInspection, (id, risk, insDate, insType, results, violations, restaurant_id))
+            storedViolations = self.add_violations(id, violations, compress_comments)
+            c.execute(addInspection, (id, risk, insDate, insType, results, storedViolations, restaurant_id))
+            self.index_violations(c.lastrowid, violations)
+            self.add_to_rollup(restaurant_id, insDate, results)
             httpResponseCode = 201
             return ({"restaurant_id": restaurant_id}, httpResponseCode)
         elif resRestaurant and not resInspection: # restaurant recorded but without inspection in DB
@@ -224,7 +495,10 @@ class DB:
                                     inspection_type, results,
                                     violations, restaurant_id)
                                 VALUES (?, ?, ?, ?, ?, ?, ?)"""
-            c.execute(addInspection, (id, risk, insDate, insType, results, violations, restaurant_id))
+            storedViolations = self.add_violations(id, violations, compress_comments)
+            c.execute(addInspection, (id, risk, insDate, insType, results, storedViolations, restaurant_id))
+            self.index_violations(c.lastrowid, violations)
+            self.add_to_rollup(restaurant_id, insDate, results)
             httpResponseCode = 200
             return ({"restaurant_id": restaurant_id}, httpResponseCode)
         else: # both restaurant and its inspection are already included in DB
@@ -263,16 +537,24 @@ class DB:
         for i in range(1,5):
             rest_name = ngrams(text, i)
             rest_names.extend(rest_name)
+        rest_names = sorted(set(rest_names))
+        # normalized like ri_restaurants.name_norm, only to probe its index
+        norm_names = sorted(set(normalize_name(n) for n in rest_names))
 
         questionmarks = ['?'] * len(rest_names)
-        matchGeo = """SELECT id FROM ri_restaurants WHERE latitude <= ? AND latitude >= ? and longitude <= ? and longitude >= ?"""
-        matchName = """SELECT id FROM ri_restaurants WHERE name in (%s)""" % (",").join(questionmarks)
+        # the R*Tree finds the candidates, its boxes are rounded outwards to 32 bit
+        # floats so the exact coordinates are checked again
+        matchGeo = """SELECT r.id FROM ri_restaurants_geo g JOIN ri_restaurants r ON r.id = g.id
+                      WHERE g.min_lat <= ?1 AND g.max_lat >= ?2 AND g.min_long <= ?3 AND g.max_long >= ?4
+                      AND r.latitude <= ?1 AND r.latitude >= ?2 and r.longitude <= ?3 and r.longitude >= ?4"""
+        matchName = """SELECT id FROM ri_restaurants WHERE name_norm in (%s) AND name in (%s)""" % (
+            (",").join(['?'] * len(norm_names)), (",").join(questionmarks))
         #Insert the tweet onto ri_tweetmatch
         addTweet = """INSERT INTO ri_tweetmatch
                             (tkey, restaurant_id, match)
                             VALUES (?, ?, ?)"""
         
-        c.execute(matchName, rest_names)
+        c.execute(matchName, norm_names + rest_names)
         nameRestID = c.fetchall()
         geoRestID = None
         if lat and long:
@@ -355,157 +637,375 @@ class DB:
         c.execute("DROP TABLE IF EXISTS temp_block")
         c.execute("""
             CREATE TEMP TABLE temp_block AS
-            SELECT *,
+            SELECT %s,
                    substr(zip, 1, 5) AS zip_block,
-                   substr(name, 1, 1) AS name_block
+                   substr(name_norm, 1, 1) AS name_block
             FROM ri_restaurants 
             WHERE clean = FALSE
-        """)
+        """ % RECORD_COLUMNS)
         self.conn.commit()
 
 
-    def match_restaurant_blocking(self):
+    def query_temp_blocks(self):
+        """
+        Yields the records of each block with one query per block.
+        """
         c = self.conn.cursor()
-        self.create_temporary_tables()
-
-        # Create an index on the temporary table for blocking
-        c.execute("""CREATE INDEX idx_zip ON temp_block(zip_block)""")
-        self.conn.commit()
-
         c.execute("SELECT DISTINCT zip_block, name_block FROM temp_block")
         blocks = to_json_list(c)
-        
-        primary_id_tracker = []
 
         for block in blocks:
             name_block, zip_block = block["name_block"], block["zip_block"], 
             
             # Fetch all records within the current block
-            c.execute("SELECT * FROM temp_block WHERE name_block = ? AND zip_block = ?", (name_block, zip_block))
-            block_records = to_json_list(c)
-
-
-            # Iterate through each dirty restaurant
-            for restaurant in block_records:
-                # Compare against every other record in the block
-                potential_matches = [r for r in block_records if r["id"] != restaurant["id"]]
-
-                # Initialize list to store linked records
-                linked_records = []
-
-                for match in potential_matches:
-                    # Calculate similarity scores for selected attributes
-                    name_similarity = jellyfish.jaro_winkler_similarity(restaurant["name"], match["name"])  
-                    address_similarity = jellyfish.jaro_winkler_similarity(restaurant["address"], match["address"])  
-                    city_similarity = jellyfish.jaro_winkler_similarity(restaurant["city"], match["city"]) 
-                    state_similarity = 1 if restaurant["state"] == match["state"] else 0  
-                    zip_similarity = 1 if restaurant["zip"] == match["zip"] else 0 
-
-                    # Combine similarity scores using a linear model by average
-                    overall_similarity = (0.3*name_similarity + 0.3*address_similarity + 0.15*city_similarity + 
-                                        0.15*state_similarity + 0.1*zip_similarity)
-
-                    if overall_similarity > 0.8: # Similarity threshold for considering a match
-                        linked_records.append(match) # Add matching record to linked list
-
-                # Check if any linked records were found
-                if linked_records:
-                    linked_records.append(restaurant)
-                    primary_record = choose_primary_record(linked_records) # dict
-
-                    # Insert entries into ri_linked table if primary record is dirty
-                    if primary_record["id"] not in primary_id_tracker:
-                        for linked_record in linked_records:
-                                # Insert into ri_linked table
-                                c.execute("INSERT INTO ri_linked (primary_rest_id, original_rest_id) VALUES (?, ?)", 
-                                        (primary_record["id"], linked_record["id"]))
-
-                                # Update ri_inspections for all linked records to point to the selected primary record
-                                c.execute("UPDATE ri_inspections SET restaurant_id = ? WHERE restaurant_id = ?", 
-                                        (primary_record["id"], linked_record["id"]))
-                        # Mark the set of selected records as clean
-                        c.execute("UPDATE ri_restaurants SET clean = TRUE WHERE id IN ({})".format(','.join([str(r["id"]) for r in linked_records])))
-                        primary_id_tracker.append(primary_record["id"])
-                        self.conn.commit()
-
-                # If a record has no candidate matches, mark the record as clean.
-                else:
-                    c.execute("INSERT INTO ri_linked (primary_rest_id, original_rest_id) VALUES (?, ?)", 
-                                    (restaurant["id"], restaurant["id"]))
-                    c.execute("UPDATE ri_restaurants SET clean = TRUE WHERE id = ?", (restaurant["id"],))
-                    c.execute("UPDATE ri_inspections SET restaurant_id = ? WHERE restaurant_id = ?", 
-                                    (restaurant["id"], restaurant["id"]))
-                    primary_id_tracker.append(restaurant["id"])
-                    self.conn.commit()
+            c.execute("SELECT %s FROM temp_block WHERE zip_block IS ? AND name_block IS ?" % RECORD_COLUMNS,
+                      (zip_block, name_block))
+            yield to_records(c)
+
+    def stream_temp_blocks(self):
+        """
+        Yields the records of each block from a single scan of temp_block ordered
+        by the block key, so only one block is held in memory at a time.
+        """
+        c = self.conn.cursor()
+        c.execute("SELECT zip_block, name_block, %s FROM temp_block ORDER BY zip_block, name_block, id"
+                  % RECORD_COLUMNS)
+
+        block_key, block_records = None, []
+        rows = c.fetchmany(STREAM_BATCH_SIZE)
+        while rows:
+            for row in rows:
+                key = row[:2]
+                if block_records and key != block_key:
+                    yield block_records
+                    block_records = []
+                block_key = key
+                block_records.append(RestaurantRecord(*row[2:]))
+            rows = c.fetchmany(STREAM_BATCH_SIZE)
+        if block_records:
+            yield block_records
+
+    def match_restaurant_blocking(self, stream=False, max_block_size=None):
+        """
+        Cleans the dirty restaurants blocked on zip and first letter of the name.
+        With stream=True the blocks are read in one ordered scan of temp_block
+        instead of one query per block. Blocks of more than max_block_size records
+        are split further with blocking.split_block.
+        """
+        c = self.conn.cursor()
+        self.reset_block_index()
+        self.create_temporary_tables()
+
+        # Create an index on the temporary table for blocking
+        c.execute("""CREATE INDEX idx_block ON temp_block(zip_block, name_block, id)""")
+        self.conn.commit()
+
+        matcher = Matcher()
+        links = []
+        block_sizes = []
+        split_blocks = 0
+        slowest_block = {"records": 0, "seconds": 0.0}
+
+        # Compute phase: blocks are disjoint, so each one is clustered on its own
+        # and only its links are kept once the next block is read
+        blocks = self.stream_temp_blocks() if stream else self.query_temp_blocks()
+        for block_records in blocks:
+            start = time.perf_counter()
+            block_links, sub_block_sizes = clean_block(block_records, matcher, max_block_size)
+            links.extend(block_links)
+            block_sizes.extend(sub_block_sizes)
+            if len(sub_block_sizes) > 1:
+                split_blocks += 1
+
+            elapsed = time.perf_counter() - start
+            logging.debug("Cleaned block of %d records (%d sub-blocks) in %.3fs"
+                          % (len(block_records), len(sub_block_sizes), elapsed))
+            if elapsed > slowest_block["seconds"]:
+                slowest_block = {"records": len(block_records), "seconds": round(elapsed, 3)}
+
+        # Write phase
+        self.write_links(links)
+
+        return {
+            "mode": "blocking-stream" if stream else "blocking",
+            "restaurants": sum(block_sizes),
+            "blocks": len(block_sizes),
+            "largest_block": max(block_sizes, default=0),
+            "block_size_histogram": size_histogram(block_sizes),
+            "split_blocks": split_blocks,
+            "slowest_block": slowest_block,
+            "candidate_pairs": sum(pairs_in(size) for size in block_sizes),
+            "matching": matcher.report(),
+        }
+
+    def match_restaurant_blocker(self, blocker):
+        """
+        Cleans the dirty restaurants using a pluggable blocker (see blocking.py).
+        The blocker proposes candidate pairs and records are clustered as in
+        match_restaurant_blocking, comparing each only with its candidates that
+        are cluster primaries.
+        """
+        c = self.conn.cursor()
+        self.reset_block_index()
+
+        c.execute("SELECT %s FROM ri_restaurants WHERE clean = FALSE ORDER BY id" % RECORD_COLUMNS)
+        dirty_restaurants = to_records(c)
+        by_id = {r.id: r for r in dirty_restaurants}
+
+        candidates = {}
+        for a, b in blocker.candidate_pairs(dirty_restaurants):
+            candidates.setdefault(a, set()).add(b)
+            candidates.setdefault(b, set()).add(a)
+
+        matcher = Matcher()
+        clusters = UnionFind()
+        cluster_by_primary(dirty_restaurants, matcher, clusters, by_id, candidates)
+
+        self.write_links(cluster_links(clusters, by_id))
+
+        stats = {"mode": "blocker"}
+        stats.update(blocker.stats)
+        stats["matching"] = matcher.report()
+        return stats
 
     def match_restaurant(self):
         c = self.conn.cursor()
+        self.reset_block_index()
 
         # Fetch all dirty and claened restaurants
-        dirty = """SELECT * FROM ri_restaurants WHERE clean = FALSE"""
-        clean = """SELECT * FROM ri_restaurants WHERE clean = TRUE"""
+        dirty = """SELECT %s FROM ri_restaurants WHERE clean = FALSE""" % RECORD_COLUMNS
+        clean = """SELECT %s FROM ri_restaurants WHERE clean = TRUE""" % RECORD_COLUMNS
 
         c.execute(dirty)
-        dirty_restaurants = to_json_list(c) # list of dicts
+        dirty_restaurants = to_records(c)
 
         c.execute(clean)
-        cleaned_restaurants = to_json_list(c)
+        cleaned_restaurants = to_records(c)
 
         all_restaurants = dirty_restaurants + cleaned_restaurants
+        by_id = {}
+
+        matcher = Matcher()
+        clusters = UnionFind()
+        # Dirty records are compared with every primary, clean ones only with dirty primaries
+        cluster_by_primary(all_restaurants, matcher, clusters, by_id,
+                           clean_ids={r.id for r in cleaned_restaurants})
+
+        self.write_links(cluster_links(clusters, by_id))
+
+        return {
+            "mode": "all-pairs",
+            "restaurants": len(dirty_restaurants),
+            "candidate_pairs": matcher.stats["pairs"],
+            "matching": matcher.report(),
+        }
+
+    def write_links(self, links, commit=True):
+        """
+        Applies the result of a clean in a single transaction. links is a list of
+        (primary_rest_id, original_rest_id) pairs: each original is linked to its
+        primary, its inspections are moved to the primary and it is marked clean.
+        Pass commit=False to add more statements to the same transaction.
+        """
+        c = self.conn.cursor()
+        c.execute("DROP TABLE IF EXISTS temp_relink")
+        c.execute("CREATE TEMP TABLE temp_relink (original_rest_id int PRIMARY KEY, primary_rest_id int NOT NULL)")
+        c.executemany("INSERT OR REPLACE INTO temp_relink (primary_rest_id, original_rest_id) VALUES (?, ?)", links)
+        c.executemany("INSERT OR IGNORE INTO ri_linked (primary_rest_id, original_rest_id) VALUES (?, ?)", links)
+
+        # Inspections moving to a primary with another zip or facility type move between rollup rows
+        # (CROSS JOIN keeps temp_relink the outer loop, so only the relinked inspections are read)
+        c.execute("""SELECT coalesce(o.zip, ''), coalesce(o.facility_type, ''), coalesce(p.zip, ''),
+                            coalesce(p.facility_type, ''), substr(i.inspection_date, 1, 7), i.results
+                     FROM temp_relink t CROSS JOIN ri_inspections i ON i.restaurant_id = t.original_rest_id
+                     JOIN ri_restaurants o ON o.id = t.original_rest_id
+                     JOIN ri_restaurants p ON p.id = t.primary_rest_id
+                     WHERE t.original_rest_id != t.primary_rest_id
+                     AND (coalesce(o.zip, '') != coalesce(p.zip, '')
+                          OR coalesce(o.facility_type, '') != coalesce(p.facility_type, ''))""")
+        deltas = {}
+        for old_zip, old_type, new_zip, new_type, month, results in c.fetchall():
+            counts = rollup_counts(results)
+            for key, sign in (((old_zip, old_type, month), -1), ((new_zip, new_type, month), 1)):
+                total = deltas.setdefault(key, [0, 0, 0, 0])
+                for k, count in enumerate(counts):
+                    total[k] += sign * count
+        c.executemany("""INSERT INTO ri_inspection_rollup (zip, facility_type, month, inspections, passed, failed, conditional)
+                         VALUES (?, ?, ?, ?, ?, ?, ?) """ + ROLLUP_UPSERT,
+                      [key + tuple(total) for key, total in deltas.items()])
+        if deltas:
+            c.execute("DELETE FROM ri_inspection_rollup WHERE inspections = 0")
+
+        # Update ri_inspections for all linked records to point to the selected primary record
+        c.execute("""UPDATE ri_inspections
+                     SET restaurant_id = (SELECT t.primary_rest_id FROM temp_relink t
+                                          WHERE t.original_rest_id = ri_inspections.restaurant_id)
+                     WHERE restaurant_id IN (SELECT original_rest_id FROM temp_relink
+                                             WHERE original_rest_id != primary_rest_id)""")
+        c.execute("UPDATE ri_restaurants SET clean = TRUE WHERE id IN (SELECT original_rest_id FROM temp_relink)")
+        c.execute("DROP TABLE temp_relink")
+        if commit:
+            self.conn.commit()
 
-        primary_id_tracker = []
-        # Iterate through each dirty restaurant
+    def reset_block_index(self):
+        """
+        Drops the persisted blocking keys so the next incremental clean rebuilds
+        them from ri_linked. Full cleans call this since they may relink clusters.
+        """
+        c = self.conn.cursor()
+        c.execute("DELETE FROM ri_blocks")
+
+    def seed_block_index(self):
+        """
+        Builds ri_blocks from the restaurants that were cleaned before the
+        incremental cleaner was used (or after a full clean reset it).
+        """
+        c = self.conn.cursor()
+        c.execute("SELECT 1 FROM ri_blocks LIMIT 1")
+        if c.fetchone():
+            return
+        c.execute("""INSERT OR IGNORE INTO ri_blocks (restaurant_id, primary_rest_id, zip_block, name_block)
+                     SELECT l.original_rest_id, l.primary_rest_id,
+                            substr(coalesce(r.zip, ''), 1, 5), substr(coalesce(r.name_norm, ''), 1, 1)
+                     FROM ri_linked l JOIN ri_restaurants r ON r.id = l.original_rest_id
+                     ORDER BY l.original_rest_id, l.primary_rest_id""")
+
+    def match_restaurant_incremental(self):
+        """
+        Cleans only the restaurants that are still dirty. Each one is compared
+        against the cluster representatives (primaries) in its block and is either
+        linked to the best scoring cluster or becomes the primary of a new one.
+        The blocking keys are kept in ri_blocks so the cost scales with the number
+        of new records rather than the size of ri_restaurants.
+        """
+        c = self.conn.cursor()
+        self.seed_block_index()
+
+        c.execute("SELECT %s FROM ri_restaurants WHERE clean = FALSE ORDER BY id" % RECORD_COLUMNS)
+        dirty_restaurants = to_records(c)
+
+        matchRepresentatives = """SELECT %s FROM ri_blocks b JOIN ri_restaurants r ON r.id = b.restaurant_id
+                                  WHERE b.zip_block = ? AND b.name_block = ?
+                                  AND b.restaurant_id = b.primary_rest_id""" % ", ".join(
+                                      "r." + column for column in RECORD_COLUMNS.split(", "))
+        matcher = Matcher()
+        compared = 0
+        links = []
+        block_rows = []
+        new_representatives = {} # clusters started during this clean, not yet in ri_blocks
         for restaurant in dirty_restaurants:
-            # Compare against every other record in the ri_restaurant (clean and dirty)
-            potential_matches = [r for r in all_restaurants if r["id"] != restaurant["id"]]
-
-            # Initialize list to store linked records
-            linked_records = []
-
-            for match in potential_matches:
-                # Calculate similarity scores for selected attributes
-                name_similarity = jellyfish.jaro_winkler_similarity(restaurant["name"], match["name"])  
-                address_similarity = jellyfish.jaro_winkler_similarity(restaurant["address"], match["address"])  
-                city_similarity = jellyfish.jaro_winkler_similarity(restaurant["city"], match["city"]) 
-                state_similarity = 1 if restaurant["state"] == match["state"] else 0  
-                zip_similarity = 1 if restaurant["zip"] == match["zip"] else 0 
-
-                # Combine similarity scores using a linear model by average
-                overall_similarity = (0.3*name_similarity + 0.3*address_similarity + 0.15*city_similarity + 
-                                      0.15*state_similarity + 0.1*zip_similarity)
-
-                if overall_similarity > 0.8: # Similarity threshold for considering a match
-                    linked_records.append(match) # Add matching record to linked list
-
-            # Check if any linked records were found
-            if linked_records:
-                linked_records.append(restaurant)
-                primary_record = choose_primary_record(linked_records) # dict
-
-                # Insert entries into ri_linked table if primary record is dirty
-                if primary_record["id"] not in primary_id_tracker:
-                    for linked_record in linked_records:
-                            # Insert into ri_linked table
-                            c.execute("INSERT INTO ri_linked (primary_rest_id, original_rest_id) VALUES (?, ?)", 
-                                    (primary_record["id"], linked_record["id"]))
-
-                            # Update ri_inspections for all linked records to point to the selected primary record
-                            c.execute("UPDATE ri_inspections SET restaurant_id = ? WHERE restaurant_id = ?", 
-                                    (primary_record["id"], linked_record["id"]))
-                    # Mark the set of selected records as clean
-                    c.execute("UPDATE ri_restaurants SET clean = TRUE WHERE id IN ({})".format(','.join([str(r["id"]) for r in linked_records])))
-                    primary_id_tracker.append(primary_record["id"])
-                    self.conn.commit()
+            key = zip_name_key(restaurant)
+            c.execute(matchRepresentatives, key)
+            representatives = to_records(c)
+            representatives.extend(new_representatives.get(key, ()))
+            compared += len(representatives)
 
-            # If a record has no candidate matches, mark the record as clean.
-            else:
-                c.execute("INSERT INTO ri_linked (primary_rest_id, original_rest_id) VALUES (?, ?)", 
-                                  (restaurant["id"], restaurant["id"]))
-                c.execute("UPDATE ri_restaurants SET clean = TRUE WHERE id = ?", (restaurant["id"],))
-                c.execute("UPDATE ri_inspections SET restaurant_id = ? WHERE restaurant_id = ?", 
-                                  (restaurant["id"], restaurant["id"]))
-                primary_id_tracker.append(restaurant["id"])
-                self.conn.commit()
+            # Link to the best scoring representative, otherwise start a new cluster
+            primary_id, best_similarity = restaurant.id, None
+            for representative in representatives:
+                similarity = matcher.score(restaurant, representative)
+                if similarity is not None and (best_similarity is None or similarity > best_similarity):
+                    primary_id, best_similarity = representative.id, similarity
+            if primary_id == restaurant.id:
+                new_representatives.setdefault(key, []).append(restaurant)
+
+            links.append((primary_id, restaurant.id))
+            block_rows.append((restaurant.id, primary_id) + key)
+
+        c.executemany("INSERT INTO ri_blocks (restaurant_id, primary_rest_id, zip_block, name_block) VALUES (?, ?, ?, ?)",
+                      block_rows)
+        self.write_links(links)
+        return {
+            "mode": "incremental",
+            "restaurants": len(dirty_restaurants),
+            "candidate_pairs": compared,
+            "matching": matcher.report(),
+        }
+
+    def create_clean_job(self):
+        c = self.conn.cursor()
+        c.execute("INSERT INTO ri_clean_jobs (status, started_at) VALUES ('running', ?)", (time.time(),))
+        self.conn.commit()
+        return c.lastrowid
+
+    def find_running_clean_jobs(self):
+        # (job id, times it was already resumed) of every job left running
+        c = self.conn.cursor()
+        c.execute("SELECT id, resumes FROM ri_clean_jobs WHERE status = 'running' ORDER BY id")
+        return c.fetchall()
+
+    def resume_clean_job(self, job_id):
+        c = self.conn.cursor()
+        c.execute("UPDATE ri_clean_jobs SET resumes = resumes + 1 WHERE id = ?", (job_id,))
+        self.conn.commit()
+
+    def find_clean_job(self, job_id):
+        """
+        Returns the progress of a cleaning job with an ETA based on the rate of
+        blocks done since the job was (re)started, or None for an unknown job.
+        """
+        c = self.conn.cursor()
+        c.execute("SELECT * FROM ri_clean_jobs WHERE id = ?", (job_id,))
+        res = to_json_list(c)
+        if not res:
+            return None
+        job = res[0]
+        now = job["finished_at"] or time.time()
+        done_since_resume = job["blocks_done"] - job["resumed_blocks_done"]
+        eta = None
+        if job["status"] == "running" and job["total_blocks"] is not None and done_since_resume > 0:
+            rate = (now - job["resumed_at"]) / done_since_resume
+            eta = round(rate * (job["total_blocks"] - job["blocks_done"]), 1)
+        return {
+            "job_id": job["id"],
+            "status": job["status"],
+            "blocks_done": job["blocks_done"],
+            "total_blocks": job["total_blocks"],
+            "pairs_scored": job["pairs_scored"],
+            "elapsed": round(now - job["started_at"], 1),
+            "eta_seconds": eta,
+            "error": job["error"],
+        }
+
+    def finish_clean_job(self, job_id, status, error=None):
+        c = self.conn.cursor()
+        c.execute("UPDATE ri_clean_jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+                  (status, error, time.time(), job_id))
+        self.conn.commit()
+
+    def match_restaurant_job(self, job_id, cancelled, max_block_size=None):
+        """
+        Runs the blocked clean for a background job. Each block is clustered and
+        written in its own transaction together with the job's progress, so a
+        restarted job only sees the blocks that still hold dirty records.
+        cancelled is a threading.Event checked between blocks. Oversized blocks
+        are split as in match_restaurant_blocking. Returns the final job status.
+        """
+        c = self.conn.cursor()
+        self.reset_block_index()
+        self.create_temporary_tables()
+        c.execute("CREATE INDEX idx_block ON temp_block(zip_block, name_block, id)")
+        c.execute("SELECT DISTINCT zip_block, name_block FROM temp_block")
+        blocks = c.fetchall()
+        c.execute("""UPDATE ri_clean_jobs SET total_blocks = blocks_done + ?, resumed_at = ?,
+                     resumed_blocks_done = blocks_done WHERE id = ?""", (len(blocks), time.time(), job_id))
+        self.conn.commit()
+
+        matcher = Matcher()
+        for zip_block, name_block in blocks:
+            if cancelled.is_set():
+                return "cancelled"
+            c.execute("SELECT %s FROM temp_block WHERE zip_block IS ? AND name_block IS ?" % RECORD_COLUMNS,
+                      (zip_block, name_block))
+            block_records = to_records(c)
+
+            pairs_before = matcher.stats["pairs"]
+            block_links, _ = clean_block(block_records, matcher, max_block_size)
+            self.write_links(block_links, commit=False)
+            c.execute("UPDATE ri_clean_jobs SET blocks_done = blocks_done + 1, pairs_scored = pairs_scored + ? WHERE id = ?",
+                      (matcher.stats["pairs"] - pairs_before, job_id))
+            self.conn.commit()
+        return "done"
 
     # Simple example of how to execute a query against the DB.
     # Again NEVER do this, you should only execute parameterized query
@@ -532,12 +1032,93 @@ def ngrams(tweet, n):
             output.append(' '.join(single_word[i:i + n]))
         return output
 
+def rollup_counts(results):
+    # (inspections, passed, failed, conditional) contributed by one inspection
+    kind = ROLLUP_RESULTS.get(results)
+    return (1, int(kind == "passed"), int(kind == "failed"), int(kind == "conditional"))
+
+def add_rollup_rates(row):
+    for kind in ROLLUP_RESULTS.values():
+        row[kind + "_rate"] = round(row[kind] / row["inspections"], 4)
+    return row
+
+def haversine_m(lat1, long1, lat2, long2):
+    # great circle distance in meters
+    lat1, long1, lat2, long2 = map(math.radians, (lat1, long1, lat2, long2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((long2 - long1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
 def choose_primary_record(linked_records):
     # choose the record with smallest restaurant id as primary record
     # replace the "name" and "address" with the longest name and address among all linked records
-    new_name = max(linked_records, key=lambda x: len(x["name"]))["name"]
-    new_address = max(linked_records, key=lambda x: len(x["address"]))["address"]
-    primary_record = min(linked_records, key=lambda x: x["id"])
-    primary_record["name"] = new_name
-    primary_record["address"] = new_address
-    return primary_record
\ No newline at end of file
+    new_name = max(linked_records, key=lambda x: len(x.name)).name
+    new_address = max(linked_records, key=lambda x: len(x.address)).address
+    primary_record = min(linked_records, key=lambda x: x.id)
+    primary_record.name = new_name
+    primary_record.address = new_address
+    return primary_record
+
+def cluster_by_primary(records, matcher, clusters, by_id, candidates=None, clean_ids=()):
+    """
+    Clusters records without chaining matches. Records are taken in id order and
+    each one joins the cluster whose primary (its lowest id, the record
+    choose_primary_record picks) it matches best, or becomes the primary of a new
+    cluster. Records are only compared with primaries, so a chain of weak matches
+    cannot pull unrelated restaurants into one cluster.
+
+    candidates maps a record id to the ids it may be compared with, default all.
+    Pairs of records in clean_ids are not compared, and clean records only enter
+    clusters that hold a dirty record.
+    """
+    primaries = {}
+    for record in sorted(records, key=lambda r: r.id):
+        by_id[record.id] = record
+        if candidates is None:
+            options = primaries.values()
+        else:
+            options = [primaries[i] for i in candidates.get(record.id, ()) if i in primaries]
+        clean = record.id in clean_ids
+
+        best, best_similarity = None, None
+        for primary in options:
+            if clean and primary.id in clean_ids:
+                continue
+            similarity = matcher.score(record, primary)
+            if similarity is not None and (best_similarity is None or similarity > best_similarity):
+                best, best_similarity = primary, similarity
+
+        if best is None:
+            primaries[record.id] = record
+            if not clean:
+                clusters.add(record.id)
+        else:
+            clusters.add(best.id)
+            clusters.add(record.id)
+            clusters.union(best.id, record.id)
+
+def clean_block(block_records, matcher, max_block_size=None):
+    """
+    Clusters one block, splitting it first when it holds more than max_block_size
+    records. Returns the block's links and the sizes of the (sub-)blocks compared.
+    """
+    sub_blocks = [block_records]
+    if max_block_size and len(block_records) > max_block_size:
+        sub_blocks = split_block(block_records, max_block_size)
+    clusters = UnionFind()
+    by_id = {}
+    for sub_block in sub_blocks:
+        # every record of the sub-block is compared with the primaries before it
+        cluster_by_primary(sub_block, matcher, clusters, by_id)
+    return cluster_links(clusters, by_id), [len(sub_block) for sub_block in sub_blocks]
+
+def cluster_links(clusters, by_id):
+    """
+    Turns the clusters into (primary_rest_id, original_rest_id) pairs, choosing the
+    primary of each cluster with choose_primary_record. Records that matched
+    nothing are their own primary.
+    """
+    links = []
+    for cluster in clusters.groups():
+        primary_record = choose_primary_record([by_id[i] for i in cluster])
+        links.extend((primary_record.id, i) for i in cluster)
+    return links
@@ -0,0 +1,70 @@
+"""
+Bulk export of inspections with their restaurants as NDJSON or CSV. The rows
+come from DB.stream_export in batches and are formatted a batch at a time, so
+neither GET /export nor the command line ever holds the whole table.
+
+    python export.py -d insp.db --format csv --clean true -o cleaned.csv
+"""
+import argparse
+import csv
+import io
+import json
+import sqlite3
+import sys
+from db import DB, EXPORT_COLUMNS
+from sharding import ShardedDB
+
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+# ?clean= / --clean values and the restaurant clean flag they filter on
+CLEAN_VALUES = {"true": True, "false": False}
+
+
+def format_batches(batches, export_format="ndjson"):
+    """
+    Yields the export as text chunks, one per batch (plus a CSV header).
+    """
+    if export_format == "csv":
+        out = io.StringIO()
+        writer = csv.DictWriter(out, fieldnames=EXPORT_COLUMNS, lineterminator="\n")
+        writer.writeheader()
+        yield out.getvalue()
+        for batch in batches:
+            out.seek(0)
+            out.truncate()
+            writer.writerows(batch)
+            yield out.getvalue()
+    else:
+        for batch in batches:
+            yield "".join(json.dumps(row) + "\n" for row in batch)
+
+
+def parse_clean(value):
+    # "true"/"false" filter on the restaurant's clean flag, no value exports both
+    if not value:
+        return None
+    if value.lower() not in CLEAN_VALUES:
+        raise ValueError("clean must be one of %s" % ", ".join(sorted(CLEAN_VALUES)))
+    return CLEAN_VALUES[value.lower()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export inspections and their restaurants")
+    parser.add_argument("-d", "--db", help="SQLite database to export (default insp.db)", default="insp.db")
+    parser.add_argument("--shards", help="Export a database sharded across this many files", default=None, type=int)
+    parser.add_argument("--format", help="Output format (default ndjson)", default="ndjson", choices=sorted(EXPORT_FORMATS))
+    parser.add_argument("--clean", help="Only restaurants that are (true) or are not (false) cleaned",
+                        choices=sorted(CLEAN_VALUES))
+    parser.add_argument("--since", help="Only rows with a seq above this watermark", default=None, type=int)
+    parser.add_argument("--no-comments", help="Leave the violation comments out", default=False, action="store_true")
+    parser.add_argument("-o", "--out", help="Output file (default stdout)")
+    args = parser.parse_args()
+
+    db = ShardedDB.open(args.db, args.shards) if args.shards else DB(sqlite3.connect(args.db))
+    batches = db.stream_export(parse_clean(args.clean), args.since, not args.no_comments)
+    out_file = open(args.out, "w", newline="") if args.out else sys.stdout
+    try:
+        for chunk in format_batches(batches, args.format):
+            out_file.write(chunk)
+    finally:
+        if args.out:
+            out_file.close()
@@ -0,0 +1,119 @@
+"""
+Background cleaning jobs. A job runs DB.match_restaurant_job on its own thread
+with its own SQLite connection, so /clean returns immediately and the API keeps
+serving requests while restaurants are cleaned.
+"""
+import logging
+import sqlite3
+import threading
+from db import DB
+from metrics import connect
+
+# A job found running again after this many resumes crashed the server each
+# time it was resumed, so it is marked failed instead of being restarted
+MAX_JOB_RESUMES = 1
+
+# Attempts at recording a job's final status, each waiting this many seconds
+# for the write lock (a /txn may hold it)
+FINISH_ATTEMPTS = 3
+FINISH_TIMEOUT = 10
+
+
+class CleanJob(threading.Thread):
+    def __init__(self, database, job_id, max_block_size=None):
+        threading.Thread.__init__(self, name="clean-job-%d" % job_id, daemon=True)
+        self.database = database
+        self.job_id = job_id
+        self.max_block_size = max_block_size
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def run(self):
+        error = None
+        conn = connect(self.database, timeout=30)
+        try:
+            status = DB(conn).match_restaurant_job(self.job_id, self.cancelled, self.max_block_size)
+        except Exception as e:
+            logging.exception("Clean job %d failed" % self.job_id)
+            status, error = "failed", str(e)
+        finally:
+            # closing rolls back the block that was being written, if any
+            conn.close()
+        if self.finish(status, error):
+            logging.info("Clean job %d %s" % (self.job_id, status))
+
+    def finish(self, status, error=None):
+        """
+        Records the job's final status on a fresh connection, retrying while the
+        database is locked. A job whose status could not be recorded stays
+        'running' and is resumed, or failed, by the next server start.
+        """
+        for attempt in range(FINISH_ATTEMPTS):
+            conn = connect(self.database, timeout=FINISH_TIMEOUT)
+            try:
+                DB(conn).finish_clean_job(self.job_id, status, error)
+                return True
+            except sqlite3.Error as e:
+                logging.error("Recording clean job %d as %s failed (attempt %d): %s" %
+                              (self.job_id, status, attempt + 1, e))
+            finally:
+                conn.close()
+        return False
+
+
+class JobManager:
+    """
+    Starts, cancels and resumes cleaning jobs. Only one job runs at a time.
+    """
+    def __init__(self, database, max_block_size=None):
+        self.database = database
+        self.max_block_size = max_block_size
+        self.jobs = {}
+
+    def running_job(self):
+        for job in self.jobs.values():
+            if job.is_alive():
+                return job
+        return None
+
+    def start(self, db):
+        """
+        Starts a cleaning job, or returns the id of the one already running.
+        """
+        job = self.running_job()
+        if job is not None:
+            return job.job_id
+        return self.launch(db.create_clean_job())
+
+    def launch(self, job_id):
+        job = CleanJob(self.database, job_id, self.max_block_size)
+        self.jobs[job_id] = job
+        job.start()
+        return job_id
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None or not job.is_alive():
+            return False
+        job.cancel()
+        job.join()
+        return True
+
+    def resume(self, db):
+        """
+        Restarts jobs left running by a previous server process. Their blocks
+        already cleaned were committed, so they pick up with the remaining ones.
+        A job still left running after MAX_JOB_RESUMES resumes is marked failed.
+        """
+        for job_id, resumes in db.find_running_clean_jobs():
+            if resumes >= MAX_JOB_RESUMES:
+                logging.error("Clean job %d left running after %d resumes, marking it failed" % (job_id, resumes))
+                db.finish_clean_job(job_id, "failed", "left running after %d resumes" % resumes)
+            elif self.running_job() is None:
+                logging.info("Resuming clean job %d" % job_id)
+                db.resume_clean_job(job_id)
+                self.launch(job_id)
+            else:
+                db.finish_clean_job(job_id, "cancelled", "superseded by job %d" % self.running_job().job_id)
@@ -0,0 +1,200 @@
+"""
+Pairwise scoring of restaurant records during cleaning. The score is a weighted
+sum of Jaro-Winkler similarities on the normalized name, address and city plus
+exact matches on state and zip; a pair is linked when it is above MATCH_THRESHOLD.
+"""
+from functools import lru_cache
+import jellyfish
+
+# Weighted similarity a pair of restaurants must exceed to be linked during cleaning
+MATCH_THRESHOLD = 0.8
+
+# Slack kept when comparing upper bounds against the threshold, so floating point
+# rounding in a bound can never prune a pair that would have matched
+BOUND_EPSILON = 1e-9
+
+# Number of distinct value pairs whose Jaro-Winkler score is remembered per clean
+SIMILARITY_CACHE_SIZE = 1 << 16
+
+# Columns cleaning reads; everything else in ri_restaurants is left in SQLite
+RECORD_COLUMNS = "id, name, address, city, state, zip, latitude, longitude, name_norm, address_norm, city_norm"
+
+
+class RestaurantRecord:
+    """
+    A restaurant row as cleaning sees it. Slots instead of a per-row dict keep
+    large blocks compact, and attribute access is cheaper in the scoring loop.
+    """
+    __slots__ = ("id", "name", "address", "city", "state", "zip", "latitude", "longitude",
+                 "name_norm", "address_norm", "city_norm")
+
+    def __init__(self, id, name, address, city, state, zip, latitude, longitude, name_norm, address_norm, city_norm):
+        self.id = id
+        self.name = name
+        self.address = address
+        self.city = city
+        self.state = state
+        self.zip = zip
+        self.latitude = latitude
+        self.longitude = longitude
+        self.name_norm = name_norm
+        self.address_norm = address_norm
+        self.city_norm = city_norm
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(*(d.get(field) for field in cls.__slots__))
+
+
+def to_records(cursor):
+    """
+    Builds a RestaurantRecord from each row of a cursor that selected RECORD_COLUMNS.
+    """
+    return [RestaurantRecord(*row) for row in cursor]
+
+
+def restaurant_similarity(restaurant, match):
+    # Calculate similarity scores for selected attributes
+    name_similarity = jellyfish.jaro_winkler_similarity(restaurant.name_norm, match.name_norm)
+    address_similarity = jellyfish.jaro_winkler_similarity(restaurant.address_norm, match.address_norm)
+    city_similarity = jellyfish.jaro_winkler_similarity(restaurant.city_norm, match.city_norm)
+    state_similarity = 1 if restaurant.state == match.state else 0
+    zip_similarity = 1 if restaurant.zip == match.zip else 0
+
+    # Combine similarity scores using a linear model by average
+    return (0.3*name_similarity + 0.3*address_similarity + 0.15*city_similarity +
+            0.15*state_similarity + 0.1*zip_similarity)
+
+
+class Matcher:
+    """
+    Decides whether two restaurants match, giving the same answer as
+    restaurant_similarity(a, b) > MATCH_THRESHOLD but skipping the remaining
+    Jaro-Winkler comparisons as soon as the best achievable score cannot
+    exceed the threshold. Counts of pruned pairs per stage are kept in stats.
+
+    Cities, shared addresses and chain names repeat a lot, so Jaro-Winkler scores
+    are memoized in a bounded LRU cache keyed on the unordered value pair.
+    """
+    def __init__(self, threshold=MATCH_THRESHOLD, cache_size=SIMILARITY_CACHE_SIZE):
+        self.threshold = threshold
+        self.cached_jaro_winkler = lru_cache(maxsize=cache_size)(self.uncached_jaro_winkler)
+        self.stats = {
+            "pairs": 0,
+            "pruned_name": 0,
+            "pruned_address": 0,
+            "jaro_winkler_calls": 0,
+            "matches": 0,
+        }
+
+    def uncached_jaro_winkler(self, a, b):
+        self.stats["jaro_winkler_calls"] += 1
+        return jellyfish.jaro_winkler_similarity(a, b)
+
+    def jaro_winkler(self, a, b):
+        # equal strings always score exactly 1.0, no need to pay for the comparison
+        if a == b and a:
+            return 1.0
+        # the score is symmetric, so (a, b) and (b, a) share a cache entry
+        if isinstance(a, str) and isinstance(b, str) and b < a:
+            a, b = b, a
+        return self.cached_jaro_winkler(a, b)
+
+    def report(self):
+        """
+        Returns the pruning counters together with the similarity cache hit rate.
+        """
+        info = self.cached_jaro_winkler.cache_info()
+        lookups = info.hits + info.misses
+        report = dict(self.stats)
+        report["cache"] = {
+            "hits": info.hits,
+            "misses": info.misses,
+            "hit_rate": round(info.hits / lookups, 4) if lookups else 0.0,
+            "size": info.currsize,
+            "max_size": info.maxsize,
+        }
+        return report
+
+    def below_threshold(self, bound):
+        return bound + BOUND_EPSILON <= self.threshold
+
+    def is_match(self, restaurant, match):
+        return self.score(restaurant, match) is not None
+
+    def score(self, restaurant, match):
+        """
+        Returns the weighted similarity of a matching pair, or None when the pair
+        is below the threshold (whether it was pruned or fully scored).
+        """
+        self.stats["pairs"] += 1
+
+        # Exact comparisons are cheap, do them first
+        state_similarity = 1 if restaurant.state == match.state else 0
+        zip_similarity = 1 if restaurant.zip == match.zip else 0
+        exact = 0.15*state_similarity + 0.1*zip_similarity
+
+        # Scores not computed yet are bounded by a perfect 1.0
+        name_similarity = self.jaro_winkler(restaurant.name_norm, match.name_norm)
+        if self.below_threshold(0.3*name_similarity + 0.3 + 0.15 + exact):
+            self.stats["pruned_name"] += 1
+            return None
+
+        address_similarity = self.jaro_winkler(restaurant.address_norm, match.address_norm)
+        if self.below_threshold(0.3*name_similarity + 0.3*address_similarity + 0.15 + exact):
+            self.stats["pruned_address"] += 1
+            return None
+
+        city_similarity = self.jaro_winkler(restaurant.city_norm, match.city_norm)
+
+        # Same expression as restaurant_similarity so the result is bit for bit identical
+        overall_similarity = (0.3*name_similarity + 0.3*address_similarity + 0.15*city_similarity +
+                              0.15*state_similarity + 0.1*zip_similarity)
+        if overall_similarity > self.threshold:
+            self.stats["matches"] += 1
+            return overall_similarity
+        return None
+
+
+class UnionFind:
+    """
+    Disjoint sets over restaurant ids, used to turn matching pairs into clusters.
+    """
+    def __init__(self, items=()):
+        self.parent = {}
+        self.size = {}
+        for item in items:
+            self.add(item)
+
+    def add(self, item):
+        if item not in self.parent:
+            self.parent[item] = item
+            self.size[item] = 1
+
+    def find(self, item):
+        root = item
+        while self.parent[root] != root:
+            root = self.parent[root]
+        # path compression
+        while self.parent[item] != root:
+            self.parent[item], item = root, self.parent[item]
+        return root
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a == root_b:
+            return root_a
+        if self.size[root_a] < self.size[root_b]:
+            root_a, root_b = root_b, root_a
+        self.parent[root_b] = root_a
+        self.size[root_a] += self.size[root_b]
+        return root_a
+
+    def groups(self):
+        """
+        Returns the clusters as lists of items, in the order items were added.
+        """
+        groups = {}
+        for item in self.parent:
+            groups.setdefault(self.find(item), []).append(item)
+        return list(groups.values())
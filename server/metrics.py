@@ -0,0 +1,234 @@
+"""
+In-process metrics. Every request is timed per route and status, together with
+the share of it spent in SQLite, and every SQL statement is timed per statement
+text with the number of rows it returned. Each series is a Histogram keeping a
+count, a sum and a window of recent observations for the p50/p95/p99 quantiles;
+GET /metrics renders them all in the Prometheus text format.
+
+Statements are timed by connecting with InstrumentedConnection: its cursors add
+up the time spent in execute and in every fetch until the statement is finished,
+that is until the last row is fetched, the cursor runs another statement or the
+cursor goes away.
+"""
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Observations each histogram keeps for its quantiles
+WINDOW_SIZE = 1024
+
+# Statements taking longer than this are logged (default of --slow-query-ms)
+SLOW_QUERY_SECONDS = 0.25
+
+WHITESPACE = re.compile(r"\s+")
+PLACEHOLDER_LIST = re.compile(r"\?(?:\s*,\s*\?)+")
+# IN lists of any length, a single ? included
+IN_LIST = re.compile(r"\b(IN)\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+
+
+def statement_key(sql):
+    # one series per statement shape: whitespace collapsed, IN (?) and IN (?,?,...) lists folded together
+    sql = IN_LIST.sub(lambda match: match.group(1) + " (?, ...)", WHITESPACE.sub(" ", sql).strip())
+    return PLACEHOLDER_LIST.sub("?, ...", sql)
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class Histogram:
+    """
+    Count and sum of all observations, quantiles over the last WINDOW_SIZE.
+    """
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=WINDOW_SIZE)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+
+    def quantiles(self):
+        values = sorted(self.recent)
+        return [(q, values[min(int(q * len(values)), len(values) - 1)]) for q in QUANTILES]
+
+
+class Metrics:
+    """
+    The histograms of one process, keyed by their label values.
+    """
+    def __init__(self, slow_query_seconds=SLOW_QUERY_SECONDS):
+        self.slow_query_seconds = slow_query_seconds
+        self.lock = threading.Lock()
+        self.requests = {}      # (method, route, status) -> seconds
+        self.request_sql = {}   # (method, route) -> seconds spent in SQL per request
+        self.queries = {}       # statement -> seconds
+        self.query_rows = {}    # statement -> rows returned
+        # runs audit(connection, sql, parameters) before each statement when set (--explain)
+        self.audit = None
+        # SQL seconds of the request the current thread is serving
+        self.local = threading.local()
+
+    def observe(self, series, key, value):
+        with self.lock:
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+
+    def start_request(self):
+        self.local.sql_seconds = 0.0
+
+    def observe_request(self, method, route, status, seconds):
+        sql_seconds = getattr(self.local, "sql_seconds", None)
+        self.local.sql_seconds = None
+        self.observe(self.requests, (method, route, status), seconds)
+        if sql_seconds is not None:
+            self.observe(self.request_sql, (method, route), sql_seconds)
+
+    def observe_query(self, sql, seconds, rows):
+        key = statement_key(sql)
+        if getattr(self.local, "sql_seconds", None) is not None:
+            self.local.sql_seconds += seconds
+        self.observe(self.queries, key, seconds)
+        self.observe(self.query_rows, key, rows)
+        if self.slow_query_seconds and seconds >= self.slow_query_seconds:
+            logging.warning("Slow query (%.1f ms, %d rows): %s" % (seconds * 1000, rows, key))
+
+    def render(self):
+        """
+        Returns every histogram as a Prometheus summary, in text format.
+        """
+        lines = []
+        with self.lock:
+            self.render_summary(lines, "http_request_duration_seconds", "Request latency by route and status",
+                                ("method", "route", "status"), self.requests)
+            self.render_summary(lines, "http_request_sql_seconds", "Time each request spent in SQL statements",
+                                ("method", "route"), self.request_sql)
+            self.render_summary(lines, "sqlite_statement_duration_seconds", "SQL statement time, execute and fetches",
+                                ("statement",), {(k,): v for k, v in self.queries.items()})
+            self.render_summary(lines, "sqlite_statement_rows", "Rows returned or changed by each SQL statement",
+                                ("statement",), {(k,): v for k, v in self.query_rows.items()})
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def render_summary(lines, name, help, label_names, series):
+        lines.append("# HELP %s %s" % (name, help))
+        lines.append("# TYPE %s summary" % name)
+        for key in sorted(series, key=lambda k: tuple(map(str, k))):
+            histogram = series[key]
+            labels = ",".join('%s="%s"' % (label, escape_label(value)) for label, value in zip(label_names, key))
+            for q, value in histogram.quantiles():
+                lines.append('%s{%s,quantile="%s"} %.6g' % (name, labels, q, value))
+            lines.append("%s_sum{%s} %.6g" % (name, labels, histogram.sum))
+            lines.append("%s_count{%s} %d" % (name, labels, histogram.count))
+
+
+METRICS = Metrics()
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """
+    A cursor reporting each statement it runs to METRICS once it is finished.
+    """
+    def __init__(self, connection):
+        sqlite3.Cursor.__init__(self, connection)
+        self.statement = None
+        self.elapsed = 0.0
+        self.rows = 0
+
+    def finish(self):
+        if self.statement is not None:
+            METRICS.observe_query(self.statement, self.elapsed, self.rows)
+            self.statement = None
+
+    def started(self, sql, start):
+        self.statement = sql
+        self.elapsed = time.perf_counter() - start
+        self.rows = 0
+        if self.description is None:
+            # nothing to fetch, count the rows changed instead
+            self.rows = max(self.rowcount, 0)
+            self.finish()
+
+    def execute(self, sql, parameters=()):
+        self.finish()
+        if METRICS.audit is not None:
+            METRICS.audit.audit(self.connection, sql, parameters)
+        start = time.perf_counter()
+        sqlite3.Cursor.execute(self, sql, parameters)
+        self.started(sql, start)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self.finish()
+        if METRICS.audit is not None:
+            # the plan does not depend on the values, so the first row stands for all
+            seq_of_parameters = list(seq_of_parameters)
+            if seq_of_parameters:
+                METRICS.audit.audit(self.connection, sql, seq_of_parameters[0])
+        start = time.perf_counter()
+        sqlite3.Cursor.executemany(self, sql, seq_of_parameters)
+        self.started(sql, start)
+        return self
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = sqlite3.Cursor.fetchone(self)
+        self.elapsed += time.perf_counter() - start
+        if row is None:
+            self.finish()
+        else:
+            self.rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        start = time.perf_counter()
+        rows = sqlite3.Cursor.fetchmany(self, size)
+        self.elapsed += time.perf_counter() - start
+        self.rows += len(rows)
+        if len(rows) < size:
+            self.finish()
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = sqlite3.Cursor.fetchall(self)
+        self.elapsed += time.perf_counter() - start
+        self.rows += len(rows)
+        self.finish()
+        return rows
+
+    def __next__(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+    def close(self):
+        self.finish()
+        sqlite3.Cursor.close(self)
+
+    def __del__(self):
+        # statements read with a single fetchone are finished when the cursor is dropped
+        if METRICS is not None:
+            self.finish()
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+
+def connect(database, **kwargs):
+    """
+    sqlite3.connect with every statement timed into METRICS.
+    """
+    return sqlite3.connect(database, factory=InstrumentedConnection, **kwargs)
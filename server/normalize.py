@@ -0,0 +1,54 @@
+"""
+Normalization of restaurant names, addresses and cities. The normalized values
+are computed once when a restaurant is inserted and stored in the name_norm,
+address_norm and city_norm columns. Cleaning scores the normalized strings, so
+case, punctuation and street suffix spellings do not count against a match. The
+tweet name match and the restaurant lookup on insert only probe the indexed
+normalized columns and still compare the raw strings exactly.
+"""
+import string
+
+# apostrophes are dropped (MCDONALD'S -> MCDONALDS), other punctuation separates words
+PUNCTUATION = str.maketrans({ch: ("" if ch == "'" else " ") for ch in string.punctuation})
+
+STREET_SUFFIXES = {
+    "AVENUE": "AVE", "AV": "AVE", "STREET": "ST", "STR": "ST", "BOULEVARD": "BLVD", "BLV": "BLVD",
+    "ROAD": "RD", "DRIVE": "DR", "PLACE": "PL", "COURT": "CT", "PARKWAY": "PKWY", "LANE": "LN",
+    "HIGHWAY": "HWY", "TERRACE": "TER", "PLAZA": "PLZ", "SQUARE": "SQ", "EXPRESSWAY": "EXPY",
+}
+
+DIRECTIONS = {"NORTH": "N", "SOUTH": "S", "EAST": "E", "WEST": "W"}
+
+
+def normalize_text(value):
+    # uppercase, punctuation stripped and whitespace collapsed
+    if not value:
+        return ""
+    return " ".join(value.upper().translate(PUNCTUATION).split())
+
+def normalize_name(name):
+    return normalize_text(name)
+
+def normalize_city(city):
+    return normalize_text(city)
+
+def normalize_address(address):
+    """
+    Canonicalizes the pre-direction after the house number and the trailing street
+    suffix, e.g. "1909 North Lincoln Avenue " -> "1909 N LINCOLN AVE". Words in the
+    middle are left alone so street names such as NORTH AVE survive.
+    """
+    words = normalize_text(address).split()
+    if len(words) > 1 and words[0][:1].isdigit() and words[1] in DIRECTIONS:
+        words[1] = DIRECTIONS[words[1]]
+    if len(words) > 1 and words[-1] in STREET_SUFFIXES:
+        words[-1] = STREET_SUFFIXES[words[-1]]
+    return " ".join(words)
+
+def normalize_restaurant(restaurant):
+    """
+    Returns (name_norm, address_norm, city_norm) for a restaurant dict.
+    """
+    return (normalize_name(restaurant.get("name")),
+            normalize_address(restaurant.get("address")),
+            normalize_city(restaurant.get("city")))
@@ -0,0 +1,90 @@
+"""
+Sampling request profiler. A fraction of requests (set with --profile-rate or
+GET /profile?rate=) and every request sent with an X-Profile: 1 header run
+under cProfile; their stats are added up per route, so /profile/stats shows
+whether a slow /clean goes to jellyfish, to_json_list or SQLite without
+redeploying. Streamed responses are profiled up to their first batch.
+"""
+import cProfile
+import pstats
+import random
+import threading
+
+# Orders /profile/stats accepts, with the field each sorts on
+SORT_KEYS = {"cumulative": "cumulative_seconds", "tottime": "total_seconds", "calls": "calls"}
+
+# Routes that are never profiled, so looking at the stats does not change them
+UNPROFILED_ROUTES = {"/profile", "/profile/stats", "/profile/reset", "/metrics"}
+
+
+def function_name(func):
+    # pstats keys functions as (file, line, name)
+    filename, line, name = func
+    if filename == "~":
+        return name  # built-in
+    return "%s:%d(%s)" % (filename, line, name)
+
+
+class Profiler:
+    def __init__(self, rate=0.0):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.routes = {}  # route -> [profiled requests, pstats.Stats]
+
+    def start(self, route, forced=False):
+        """
+        Returns a running cProfile.Profile when this request is to be profiled.
+        """
+        if route is None or route in UNPROFILED_ROUTES:
+            return None
+        if not forced and (self.rate <= 0 or random.random() >= self.rate):
+            return None
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def stop(self, route, profile):
+        profile.disable()
+        with self.lock:
+            if route in self.routes:
+                self.routes[route][0] += 1
+                self.routes[route][1].add(profile)
+            else:
+                self.routes[route] = [1, pstats.Stats(profile)]
+
+    def reset(self):
+        with self.lock:
+            self.routes = {}
+
+    def summary(self):
+        with self.lock:
+            return {"rate": self.rate, "routes": {route: requests for route, (requests, _) in sorted(self.routes.items())}}
+
+    def report(self, route=None, sort="cumulative", limit=30):
+        """
+        Returns the top limit functions of each route (or just route) by sort.
+        """
+        res = {}
+        with self.lock:
+            for name, (requests, stats) in sorted(self.routes.items()):
+                if route is not None and name != route:
+                    continue
+                functions = []
+                for func, (primitive_calls, calls, total, cumulative, _) in stats.stats.items():
+                    functions.append({
+                        "function": function_name(func),
+                        "calls": calls,
+                        "primitive_calls": primitive_calls,
+                        "total_seconds": round(total, 6),
+                        "cumulative_seconds": round(cumulative, 6),
+                    })
+                functions.sort(key=lambda f: f[SORT_KEYS[sort]], reverse=True)
+                res[name] = {
+                    "requests": requests,
+                    "seconds": round(stats.total_tt, 6),
+                    "functions": functions[:limit],
+                }
+        return res
+
+
+PROFILER = Profiler()
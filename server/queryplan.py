@@ -0,0 +1,131 @@
+"""
+Query plan audit. The server's --explain debug mode installs PLANS as
+METRICS.audit, so every distinct statement run on the instrumented connections
+of metrics.py, dynamic IN (...) queries included, goes once through EXPLAIN
+QUERY PLAN. The plans are kept with the routes that ran each statement, and
+full scans of the large tables on a request path are flagged, so a missing
+index shows up as soon as the workload touches it. GET /explain returns the
+report; this module's command line fetches it and fails when anything is
+flagged:
+
+    python queryplan.py -p 30235
+"""
+import argparse
+import json
+import re
+import sqlite3
+import sys
+import threading
+import requests
+from metrics import statement_key
+
+# Tables a full scan of which is a bug on a request path
+HOT_TABLES = {"ri_restaurants", "ri_inspections", "ri_tweetmatch", "ri_linked"}
+
+# Routes expected to read whole tables, their scans are reported but not flagged
+BULK_ROUTES = {"/create", "/reset", "/seed", "/clean", "/export", "/count", "/explain"}
+
+SCAN_PATTERN = re.compile(r"^SCAN (?:TABLE )?(\w+)")
+TABLE_PATTERN = re.compile(r"\b(?:FROM|JOIN|INTO|UPDATE)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?", re.IGNORECASE)
+NOT_ALIASES = {"where", "on", "join", "left", "inner", "cross", "natural", "group", "order", "limit", "using",
+               "select", "set", "values", "union", "default"}
+
+
+def table_aliases(sql):
+    """
+    Maps every table name and alias after FROM/JOIN/INTO/UPDATE to the table.
+    """
+    aliases = {}
+    for table, alias in TABLE_PATTERN.findall(sql):
+        aliases[table.lower()] = table.lower()
+        if alias and alias.lower() not in NOT_ALIASES:
+            aliases[alias.lower()] = table.lower()
+    return aliases
+
+
+class PlanAudit:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.statements = {}  # statement key -> plan, scans, executions per route
+        # route of the request the current thread is serving
+        self.local = threading.local()
+
+    def set_route(self, route):
+        self.local.route = route
+
+    def audit(self, connection, sql, parameters):
+        key = statement_key(sql)
+        route = getattr(self.local, "route", None)
+        with self.lock:
+            entry = self.statements.get(key)
+            if entry is not None:
+                entry["routes"][route] = entry["routes"].get(route, 0) + 1
+                return
+        entry = self.explain(connection, sql, parameters)
+        entry["routes"] = {route: 1}
+        with self.lock:
+            self.statements.setdefault(key, entry)
+
+    @staticmethod
+    def explain(connection, sql, parameters):
+        # a plain cursor, so the EXPLAIN itself is neither timed nor audited
+        try:
+            rows = sqlite3.Cursor(connection).execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+        except sqlite3.Error as e:
+            return {"plan": [], "scans": [], "error": str(e)}
+        aliases = table_aliases(sql)
+        plan = [row[3] for row in rows]
+        scans = []
+        for detail in plan:
+            match = SCAN_PATTERN.match(detail)
+            if match:
+                table = aliases.get(match.group(1).lower(), match.group(1).lower())
+                if table in HOT_TABLES and table not in scans:
+                    scans.append(table)
+        return {"plan": plan, "scans": scans}
+
+    def report(self, flagged_only=False):
+        """
+        Returns the audited statements, flagged ones first. A statement is flagged
+        when it scans a hot table and ran for a route outside BULK_ROUTES;
+        statements of background jobs run outside any route.
+        """
+        with self.lock:
+            entries = [dict(entry, statement=key, routes=dict(entry["routes"]))
+                       for key, entry in self.statements.items()]
+        res = []
+        for entry in entries:
+            hot_routes = [r for r in entry["routes"] if r is not None and r not in BULK_ROUTES]
+            entry["flagged"] = bool(entry["scans"] and hot_routes)
+            entry["routes"] = {str(r) if r is not None else "background": n for r, n in entry["routes"].items()}
+            if entry["flagged"] or not flagged_only:
+                res.append(entry)
+        res.sort(key=lambda entry: (not entry["flagged"], entry["statement"]))
+        return res
+
+
+PLANS = PlanAudit()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report the query plans a server running with --explain has seen")
+    parser.add_argument("-s", "--server", help="Server hostname (default localhost)", default="127.0.0.1")
+    parser.add_argument("-p", "--port", help="Server port (default 30235)", default=30235, type=int)
+    parser.add_argument("-a", "--all", help="List every statement, not only flagged ones", default=False,
+                        action="store_true")
+    args = parser.parse_args()
+
+    r = requests.get("http://%s:%s/explain" % (args.server, args.port),
+                     params={} if args.all else {"flagged": "true"})
+    r.raise_for_status()
+    statements = r.json()
+    for entry in statements:
+        print("%s %s" % ("FLAGGED" if entry["flagged"] else "ok     ", entry["statement"]))
+        print("        routes: %s" % json.dumps(entry["routes"]))
+        for detail in entry["plan"]:
+            print("        %s" % detail)
+        if "error" in entry:
+            print("        error: %s" % entry["error"])
+    flagged = sum(1 for entry in statements if entry["flagged"])
+    print("%d statements, %d flagged" % (len(statements), flagged))
+    sys.exit(1 if flagged else 0)
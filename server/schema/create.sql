@@ -1,7 +1,16 @@
+DROP TABLE IF EXISTS ri_restaurants_fts;
+DROP TABLE IF EXISTS ri_restaurants_geo;
+DROP TABLE IF EXISTS ri_violations_fts;
+DROP TABLE IF EXISTS ri_violations;
+DROP TABLE IF EXISTS ri_violation_types;
 DROP TABLE IF EXISTS ri_inspections;
 DROP TABLE IF EXISTS ri_restaurants;
 DROP TABLE IF EXISTS ri_tweetmatch;
 DROP TABLE IF EXISTS ri_linked;
+DROP TABLE IF EXISTS ri_blocks;
+DROP TABLE IF EXISTS ri_clean_jobs;
+DROP TABLE IF EXISTS ri_inspection_rollup;
+DROP TABLE IF EXISTS ri_changes;
 
 CREATE TABLE ri_restaurants (
     id integer PRIMARY KEY AUTOINCREMENT,
@@ -13,32 +22,186 @@ CREATE TABLE ri_restaurants (
     zip char(5),
     latitude real,
     longitude real,
-    clean boolean DEFAULT FALSE
+    clean boolean DEFAULT FALSE,
+    -- normalized copies computed at insert time (see normalize.py)
+    name_norm varchar(60),
+    address_norm varchar(60),
+    city_norm varchar(30)
 );
 
+CREATE INDEX idx_restaurants_norm ON ri_restaurants(name_norm, address_norm);
+
+-- Only the restaurants still to be cleaned, so incremental cleaning reads them without a table scan
+CREATE INDEX idx_restaurants_dirty ON ri_restaurants(id) WHERE clean = FALSE;
+
+-- Spatial index of restaurant locations for /restaurants/near and tweet matching,
+-- kept in sync by triggers. Restaurants without numeric coordinates are left out.
+CREATE VIRTUAL TABLE ri_restaurants_geo USING rtree(id, min_lat, max_lat, min_long, max_long);
+
+CREATE TRIGGER ri_restaurants_geo_insert AFTER INSERT ON ri_restaurants
+WHEN typeof(new.latitude) IN ('real', 'integer') AND typeof(new.longitude) IN ('real', 'integer') BEGIN
+    INSERT INTO ri_restaurants_geo VALUES (new.id, new.latitude, new.latitude, new.longitude, new.longitude);
+END;
+
+CREATE TRIGGER ri_restaurants_geo_delete AFTER DELETE ON ri_restaurants BEGIN
+    DELETE FROM ri_restaurants_geo WHERE id = old.id;
+END;
+
+CREATE TRIGGER ri_restaurants_geo_update AFTER UPDATE OF latitude, longitude ON ri_restaurants BEGIN
+    DELETE FROM ri_restaurants_geo WHERE id = old.id;
+    INSERT INTO ri_restaurants_geo SELECT new.id, new.latitude, new.latitude, new.longitude, new.longitude
+    WHERE typeof(new.latitude) IN ('real', 'integer') AND typeof(new.longitude) IN ('real', 'integer');
+END;
+
+-- Full-text index of restaurant names and addresses for /search, kept in sync by triggers
+CREATE VIRTUAL TABLE ri_restaurants_fts USING fts5(
+    name, address, content='ri_restaurants', content_rowid='id', tokenize='porter unicode61'
+);
+
+CREATE TRIGGER ri_restaurants_fts_insert AFTER INSERT ON ri_restaurants BEGIN
+    INSERT INTO ri_restaurants_fts (rowid, name, address) VALUES (new.id, new.name, new.address);
+END;
+
+CREATE TRIGGER ri_restaurants_fts_delete AFTER DELETE ON ri_restaurants BEGIN
+    INSERT INTO ri_restaurants_fts (ri_restaurants_fts, rowid, name, address) VALUES ('delete', old.id, old.name, old.address);
+END;
+
+CREATE TRIGGER ri_restaurants_fts_update AFTER UPDATE OF name, address ON ri_restaurants BEGIN
+    INSERT INTO ri_restaurants_fts (ri_restaurants_fts, rowid, name, address) VALUES ('delete', old.id, old.name, old.address);
+    INSERT INTO ri_restaurants_fts (rowid, name, address) VALUES (new.id, new.name, new.address);
+END;
+
 -- Update the ri_inspections for all linked records to point to the selected primary record.
 CREATE TABLE ri_inspections (
-    id varchar(16),
+    -- load order, for the export watermark and the violations index; declared
+    -- so that VACUUM cannot renumber it the way it can an implicit rowid
+    seq integer PRIMARY KEY AUTOINCREMENT,
+    id varchar(16) NOT NULL UNIQUE,
     risk varchar(30),
-    inspection_date date,
+    inspection_date date, -- ISO YYYY-MM-DD
     inspection_type varchar(30),
     results varchar(30),
+    -- the posted narrative when it could not be split into ri_violations, otherwise NULL
     violations text,
     restaurant_id int NOT NULL,
-    PRIMARY KEY (id),
     FOREIGN KEY (restaurant_id) REFERENCES ri_restaurants
 );
 
+CREATE INDEX idx_inspections_date ON ri_inspections(inspection_date, restaurant_id);
+-- Inspections of a restaurant, for reads and for moving them to a primary during cleaning
+CREATE INDEX idx_inspections_restaurant ON ri_inspections(restaurant_id);
+
+-- Full-text index of the posted violations narratives for /search, rowid is the
+-- ri_inspections seq. Contentless, the text itself is kept in ri_violations
+-- (or ri_inspections.violations).
+CREATE VIRTUAL TABLE ri_violations_fts USING fts5(
+    violations, content='', tokenize='porter unicode61'
+);
+
+-- Violation codes and descriptions, shared by every inspection citing them (see violations.py)
+CREATE TABLE ri_violation_types (
+    id integer PRIMARY KEY AUTOINCREMENT,
+    code int NOT NULL,
+    description text NOT NULL,
+    UNIQUE (code, description)
+);
+
+-- The violations of an inspection in posted order. comments is TEXT, or a
+-- zlib-compressed BLOB of the UTF-8 text; it is kept last so reads that skip
+-- it do not touch its overflow pages.
+CREATE TABLE ri_violations (
+    inspection_id varchar(16) NOT NULL,
+    seq int NOT NULL,
+    type_id int NOT NULL,
+    comments text,
+    PRIMARY KEY (inspection_id, seq),
+    FOREIGN KEY (inspection_id) REFERENCES ri_inspections,
+    FOREIGN KEY (type_id) REFERENCES ri_violation_types
+);
+
 CREATE TABLE ri_tweetmatch (
     tkey varchar(100),
     restaurant_id int,
     match varchar(20) CHECK( match IN ('geo','name','both'))  NOT NULL
 );
 
+-- Tweets matched to a restaurant, for /tweets/<restaurant_id>
+CREATE INDEX idx_tweetmatch_restaurant ON ri_tweetmatch(restaurant_id);
+
 CREATE TABLE ri_linked (
     primary_rest_id int,
     original_rest_id int,
     PRIMARY KEY (primary_rest_id, original_rest_id),
     FOREIGN KEY (primary_rest_id) REFERENCES ri_restaurants,
     FOREIGN KEY (original_rest_id) REFERENCES ri_restaurants
-);
\ No newline at end of file
+);
+
+-- Lookups by the linked restaurant, e.g. skipping non-primaries in /restaurants/near
+CREATE INDEX idx_linked_original ON ri_linked(original_rest_id);
+-- Blocking key and cluster primary of every cleaned restaurant, kept for incremental cleaning.
+-- Cluster representatives are the rows where restaurant_id = primary_rest_id.
+CREATE TABLE ri_blocks (
+    restaurant_id int PRIMARY KEY,
+    primary_rest_id int NOT NULL,
+    zip_block char(5),
+    name_block char(1),
+    FOREIGN KEY (restaurant_id) REFERENCES ri_restaurants,
+    FOREIGN KEY (primary_rest_id) REFERENCES ri_restaurants
+);
+
+CREATE INDEX idx_blocks_key ON ri_blocks(zip_block, name_block, primary_rest_id);
+
+-- Background cleaning jobs; progress is committed with every block that is cleaned.
+CREATE TABLE ri_clean_jobs (
+    id integer PRIMARY KEY AUTOINCREMENT,
+    status varchar(10) CHECK( status IN ('running','done','cancelled','failed')) NOT NULL,
+    total_blocks int,
+    blocks_done int NOT NULL DEFAULT 0,
+    pairs_scored int NOT NULL DEFAULT 0,
+    started_at real NOT NULL,
+    resumed_at real,
+    resumed_blocks_done int NOT NULL DEFAULT 0,
+    resumes int NOT NULL DEFAULT 0,
+    finished_at real,
+    error text
+);
+
+-- Inspection counts per restaurant zip, facility type and YYYY-MM month for /stats.
+-- Updated as inspections are added and corrected when cleaning moves them.
+CREATE TABLE ri_inspection_rollup (
+    zip char(5) NOT NULL,
+    facility_type varchar(30) NOT NULL,
+    month char(7) NOT NULL,
+    inspections int NOT NULL DEFAULT 0,
+    passed int NOT NULL DEFAULT 0,
+    failed int NOT NULL DEFAULT 0,
+    conditional int NOT NULL DEFAULT 0,
+    PRIMARY KEY (zip, facility_type, month)
+) WITHOUT ROWID;
+
+-- Change feed for /changes: every inserted inspection and tweet match and every
+-- restaurant cleaning links into another one, in commit order. Filled by triggers.
+CREATE TABLE ri_changes (
+    seq integer PRIMARY KEY AUTOINCREMENT,
+    kind varchar(10) CHECK( kind IN ('inspection','tweet','relink')) NOT NULL,
+    item_id varchar(100) NOT NULL, -- inspection id, tweet key or linked restaurant id
+    restaurant_id int,             -- the inspection's restaurant, matched restaurant or new primary
+    detail varchar(30),            -- inspection results or tweet match type
+    changed_at real NOT NULL
+);
+
+CREATE TRIGGER ri_changes_inspection AFTER INSERT ON ri_inspections BEGIN
+    INSERT INTO ri_changes (kind, item_id, restaurant_id, detail, changed_at)
+    VALUES ('inspection', new.id, new.restaurant_id, new.results, (julianday('now') - 2440587.5) * 86400.0);
+END;
+
+CREATE TRIGGER ri_changes_tweet AFTER INSERT ON ri_tweetmatch BEGIN
+    INSERT INTO ri_changes (kind, item_id, restaurant_id, detail, changed_at)
+    VALUES ('tweet', new.tkey, new.restaurant_id, new.match, (julianday('now') - 2440587.5) * 86400.0);
+END;
+
+CREATE TRIGGER ri_changes_relink AFTER INSERT ON ri_linked
+WHEN new.original_rest_id != new.primary_rest_id BEGIN
+    INSERT INTO ri_changes (kind, item_id, restaurant_id, detail, changed_at)
+    VALUES ('relink', new.original_rest_id, new.primary_rest_id, NULL, (julianday('now') - 2440587.5) * 86400.0);
+END;
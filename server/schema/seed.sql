@@ -6,7 +6,10 @@ INSERT INTO ri_restaurants (
     state,
     zip,
     latitude,
-    longitude
+    longitude,
+    name_norm,
+    address_norm,
+    city_norm
 ) VALUES (
     'DAMEN DINING',
     'Restaurant',
@@ -15,7 +18,10 @@ INSERT INTO ri_restaurants (
     'IL',
     '60613',
     41.94915225433,
-    -87.6544465886
+    -87.6544465886,
+    'DAMEN DINING',
+    '1000 1010 W WAVELAND AVE',
+    'CHICAGO'
 );
 
 INSERT INTO ri_inspections (
@@ -33,6 +39,19 @@ INSERT INTO ri_inspections (
     'License',
     'Pass',
     '32. FOOD AND NON-FOOD CONTACT SURFACES PROPERLY DESIGNED, CONSTRUCTED AND MAINTAINED - Comments: OBSERVED RUSTED FOOD STORAGE SHELVING INSIDE WALK-IN COOLER LOCATED AT THE ROOFTOP. MUST REPAINT OR REPLACE. | 38. VENTILATION: ROOMS AND EQUIPMENT VENTED AS REQUIRED: PLUMBING: INSTALLED AND MAINTAINED - Comments: OBSERVED EXPOSED HAND WASHING DRAINING SLOW IN KITCHEN FOOD PREP AREA LOCATED AT THE ROOFTOP. MUST REPAIR AND MAINTAIN. \nVENTILATION NOT WORKING AT THE ROOFTOP WASHROOMS. MUST REPAIR AND MAINTAIN.',
-    1
+    last_insert_rowid()
 );
 
+INSERT INTO ri_violations_fts (rowid, violations)
+SELECT seq, violations FROM ri_inspections WHERE id = '1751552';
+
+INSERT INTO ri_inspection_rollup (zip, facility_type, month, inspections, passed, failed, conditional)
+SELECT r.zip, r.facility_type, substr(i.inspection_date, 1, 7), 1,
+       i.results = 'Pass', i.results = 'Fail', i.results = 'Pass w/ Conditions'
+FROM ri_inspections i JOIN ri_restaurants r ON r.id = i.restaurant_id
+WHERE i.id = '1751552'
+ON CONFLICT (zip, facility_type, month) DO UPDATE SET
+    inspections = inspections + excluded.inspections,
+    passed = passed + excluded.passed,
+    failed = failed + excluded.failed,
+    conditional = conditional + excluded.conditional;
@@ -4,9 +4,19 @@ import requests  # Used for web/html wrapper
 import argparse  # Used for getting arguments for creating server
 import sqlite3  # Our DB
 import logging  # Logging Library
-from db import DB  # our custom data access layer
+from datetime import datetime  # For parsing date query parameters
+from db import DB, ROLLUP_GROUPS  # our custom data access layer
+from blocking import BLOCKERS, make_blocker  # pluggable blocking strategies for cleaning
+from jobs import JobManager  # background cleaning jobs
+from sharding import ShardedDB  # storage partitioned by zip across several files
+from export import EXPORT_FORMATS, format_batches, parse_clean  # bulk export formatting
+from metrics import METRICS, connect  # request and SQL statement histograms
+from queryplan import PLANS  # EXPLAIN QUERY PLAN audit of every statement
+from profiling import PROFILER, SORT_KEYS  # sampled cProfile stats per route
 from errors import KeyNotFound, BadRequest, InvalidUsage # Custom Error types
 import string  # for ngram generation
+import itertools  # for chaining streamed batches
+import time  # for timing requests
 
 
 # Configure application
@@ -41,11 +51,112 @@ def get_db_conn():
     """
     if "_database" not in app.config:
         # create a connection to the DB insp.db in the current working directory
-        app.config["_database"] = sqlite3.connect(DATABASE)
+        app.config["_database"] = connect(DATABASE)
         return app.config["_database"] 
     else:
         return app.config["_database"] 
 
+def get_read_conn():
+    """
+    gets a second connection to the database that never writes, so reads through
+    it only see committed data even while /txn holds a transaction open
+    """
+    if "_read_database" not in app.config:
+        app.config["_read_database"] = connect(DATABASE)
+    return app.config["_read_database"]
+
+def get_db():
+    """
+    gets the data access layer, sharded across several database files with --shards
+    """
+    if app.config.get("shards"):
+        if "_sharded_database" not in app.config:
+            app.config["_sharded_database"] = ShardedDB.open(DATABASE, app.config["shards"])
+        return app.config["_sharded_database"]
+    return DB(get_db_conn())
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+    METRICS.start_request()
+    route = request.url_rule.rule if request.url_rule else None
+    PLANS.set_route(route)
+    # started last, so only the request itself is profiled
+    g.profile = PROFILER.start(route, request.headers.get("X-Profile") == "1")
+
+
+@app.after_request
+def record_request(response):
+    # streamed responses are timed up to their first batch
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    if g.get("profile") is not None:
+        PROFILER.stop(route, g.profile)
+    METRICS.observe_request(request.method, route, response.status_code,
+                            time.perf_counter() - g.request_start)
+    return response
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    Request and SQL statement histograms in the Prometheus text format.
+    """
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/profile", methods=["GET"])
+def profile():
+    """
+    The share of requests profiled and how many were profiled per route.
+    ?rate= (0 to 1) changes the share, 0 only profiles requests sent with an
+    X-Profile: 1 header.
+    """
+    rate = request.args.get("rate")
+    if rate is not None:
+        try:
+            rate = float(rate)
+        except ValueError:
+            rate = -1
+        if not 0 <= rate <= 1:
+            raise InvalidUsage("rate must be between 0 and 1", status_code=400)
+        PROFILER.rate = rate
+    return jsonify(PROFILER.summary()), 200
+
+
+@app.route("/profile/stats", methods=["GET"])
+def profile_stats():
+    """
+    The top ?limit= (default 30) functions of each profiled route by ?sort=
+    (cumulative, tottime or calls), or of just ?route=, e.g.
+    /profile/stats?route=/tweet&sort=tottime
+    """
+    sort = request.args.get("sort", "cumulative")
+    if sort not in SORT_KEYS:
+        raise InvalidUsage("sort must be one of %s" % ", ".join(sorted(SORT_KEYS)), status_code=400)
+    try:
+        limit = int(request.args.get("limit", 30))
+    except ValueError:
+        raise InvalidUsage("limit must be an integer", status_code=400)
+    return jsonify(PROFILER.report(request.args.get("route"), sort, limit)), 200
+
+
+@app.route("/profile/reset", methods=["GET"])
+def profile_reset():
+    PROFILER.reset()
+    return {"message": "reset"}
+
+
+@app.route("/explain", methods=["GET"])
+def explain():
+    """
+    The query plans seen with --explain, flagged full scans of large tables on
+    request paths first; ?flagged=true lists only those.
+    """
+    if METRICS.audit is None:
+        raise InvalidUsage("query plans are only recorded with --explain", status_code=400)
+    return jsonify(PLANS.report(request.args.get("flagged", "false").lower() == "true")), 200
+
+
 # default path
 @app.route('/')
 def home():
@@ -61,14 +172,14 @@ def hello():
 @app.route("/reset", methods=["GET"])
 def create():
     logging.debug("Running Create/Reset")
-    db = DB(get_db_conn())
+    db = get_db()
     db.create_script()
     return {"message": "created"}
 
 
 @app.route("/seed", methods=["GET"])
 def seed():
-    db = DB(get_db_conn())
+    db = get_db()
     db.seed_data()
     return {"message": "seeded"}
 
@@ -78,12 +189,12 @@ def find_restaurant(restaurant_id):
     """
     Returns a restaurant and all of its associated inspections.
     """
-    db = DB(get_db_conn())
+    db = get_db()
 
     # TODO milestone 1
     try:
         restaurant, httpResponseCode = db.find_restaurant(restaurant_id)
-        inspections = db.find_inspections(restaurant_id)
+        inspections = db.find_inspections(restaurant_id, comments_requested())
         restaurant["inspections"] = inspections
         return jsonify(restaurant), httpResponseCode
     except KeyNotFound as e:
@@ -94,12 +205,44 @@ def find_restaurant(restaurant_id):
         raise InvalidUsage(str(e))
 
 
+# Defaults and limits of /restaurants/near
+NEAR_RADIUS_M = 500
+NEAR_MAX_RADIUS_M = 50000
+NEAR_LIMIT = 10
+NEAR_MAX_LIMIT = 100
+
+@app.route("/restaurants/near", methods=["GET"])
+def find_restaurants_near():
+    """
+    Returns the restaurants within ?radius= meters (default 500) of ?lat= and
+    ?long=, nearest first, at most ?limit= (default 10) of them.
+    """
+    try:
+        lat = float(request.args["lat"])
+        long = float(request.args["long"])
+        radius = float(request.args.get("radius", NEAR_RADIUS_M))
+        limit = int(request.args.get("limit", NEAR_LIMIT))
+    except (KeyError, ValueError):
+        raise InvalidUsage("lat and long are required, radius and limit must be numbers", status_code=400)
+    if not 0 < radius <= NEAR_MAX_RADIUS_M or not 1 <= limit <= NEAR_MAX_LIMIT:
+        raise InvalidUsage("radius must be at most %d meters and limit between 1 and %d"
+                           % (NEAR_MAX_RADIUS_M, NEAR_MAX_LIMIT), status_code=400)
+
+    db = get_db()
+    try:
+        restaurants = db.find_restaurants_near(lat, long, radius, limit)
+    except sqlite3.Error as e:
+        logging.error(e)
+        raise InvalidUsage(str(e))
+    return jsonify(restaurants), 200
+
+
 @app.route("/restaurants/by-inspection/<inspection_id>", methods=["GET"])
 def find_restaurant_by_inspection_id(inspection_id):
     """
     Returns a restaurant associated with a given inspection.
     """
-    db = DB(get_db_conn())
+    db = get_db()
 
     # TODO milestone 1
     try:
@@ -115,7 +258,7 @@ def find_restaurant_by_inspection_id(inspection_id):
 @app.route("/restaurants/all-by-inspection/<inspection_id>",methods=["GET"])
 def find_all_restaurants_by_inspection_id(inspection_id):
     # TODO milestone 3
-    db = DB(get_db_conn())
+    db = get_db()
     rest_set = {}
     try:
         primary_restaurant, linked_restaurants, ids = db.find_linked_restaurants_by_inspection_id(inspection_id)
@@ -138,7 +281,7 @@ def load_inspection():
     Note that if db or server throws a KeyNotFound, BadRequest or InvalidUsage error
     the web framework will automatically generate the right error response.
     """
-    db = DB(get_db_conn())
+    db = get_db()
 
     # TODO milestone 1
     post_body = request.get_json() # parse the incoming JSON request data into dicts
@@ -152,7 +295,8 @@ def load_inspection():
     
     try:
         # add a record via the DB class
-        resp, httpResponseCode = db.add_inspection_for_restaurant(inspection, restaurant)
+        resp, httpResponseCode = db.add_inspection_for_restaurant(inspection, restaurant,
+                                                                  app.config['compress_comments'])
         app.config["INSPECTION_IN_TRANSACTION"] += 1
         if app.config["INSPECTION_IN_TRANSACTION"] == app.config["TRANSACTION_SIZE"]:
             commit_txn()
@@ -167,6 +311,172 @@ def load_inspection():
         raise InvalidUsage(str(e))
 
 
+@app.route("/inspections", methods=["GET"])
+def find_inspections_by_date():
+    """
+    Streams the inspections dated between ?from= and ?to= (YYYY-MM-DD, both
+    inclusive and optional) as a JSON list, optionally only those whose results
+    equal ?result=, e.g. /inspections?from=2020-04-13&to=2020-04-19&result=Fail
+    """
+    db = get_db()
+    try:
+        start, end = (parse_date_arg(name) for name in ("from", "to"))
+        batches = db.stream_inspections(start, end, request.args.get("result"), comments_requested())
+        # run the query now so errors are reported before the response starts
+        first = next(batches, [])
+    except sqlite3.Error as e:
+        logging.error(e)
+        raise InvalidUsage(str(e))
+
+    def generate():
+        yield "["
+        separator = ""
+        for batch in itertools.chain([first], batches):
+            for inspection in batch:
+                yield separator + json.dumps(inspection)
+                separator = ","
+        yield "]"
+    return Response(generate(), mimetype="application/json")
+
+
+# Results per page of /search, unless ?per_page= asks for fewer or more (up to the maximum)
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+
+@app.route("/search", methods=["GET"])
+def search():
+    """
+    Full-text search over restaurant names, addresses and violations, e.g.
+    /search?q=rodent droppings&page=2. All words have to match; ?type=restaurant
+    or ?type=inspection restricts the results to one kind.
+    """
+    terms = request.args.get("q", "").split()
+    if not terms:
+        raise InvalidUsage("q is required", status_code=400)
+    kind = request.args.get("type")
+    if kind not in (None, "restaurant", "inspection"):
+        raise InvalidUsage("type must be restaurant or inspection", status_code=400)
+    try:
+        page = int(request.args.get("page", 1))
+        per_page = int(request.args.get("per_page", SEARCH_PAGE_SIZE))
+    except ValueError:
+        raise InvalidUsage("page and per_page must be integers", status_code=400)
+    if page < 1 or not 1 <= per_page <= SEARCH_MAX_PAGE_SIZE:
+        raise InvalidUsage("page must be positive and per_page between 1 and %d" % SEARCH_MAX_PAGE_SIZE,
+                           status_code=400)
+
+    db = get_db()
+    try:
+        results = db.search(terms, per_page, (page - 1) * per_page, kind)
+    except sqlite3.Error as e:
+        logging.error(e)
+        raise InvalidUsage(str(e))
+    return jsonify({"q": " ".join(terms), "page": page, "per_page": per_page, "results": results}), 200
+
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    """
+    Inspection counts and pass/fail/conditional rates from the rollup table,
+    grouped by ?group= (comma separated zip, facility_type, month; all three by
+    default, empty for overall totals), e.g.
+    /stats?group=month&zip=60614&from=2020-01&to=2020-06
+    """
+    group = request.args.get("group")
+    group_by = ROLLUP_GROUPS if group is None else [g for g in group.split(",") if g]
+    if any(g not in ROLLUP_GROUPS for g in group_by):
+        raise InvalidUsage("group must be a list of %s" % ", ".join(ROLLUP_GROUPS), status_code=400)
+
+    db = get_db()
+    try:
+        res = db.find_stats(group_by, request.args.get("zip"), request.args.get("facility_type"),
+                            request.args.get("from"), request.args.get("to"))
+    except sqlite3.Error as e:
+        logging.error(e)
+        raise InvalidUsage(str(e))
+    return jsonify(res), 200
+
+
+@app.route("/export", methods=["GET"])
+def export():
+    """
+    Streams every inspection with its restaurant as NDJSON (default) or CSV,
+    e.g. /export?format=csv&clean=true&since=1200. ?since= takes the seq of the
+    last row of an earlier export and only returns the rows loaded after it.
+    """
+    export_format = request.args.get("format", "ndjson")
+    if export_format not in EXPORT_FORMATS:
+        raise InvalidUsage("format must be one of %s" % ", ".join(sorted(EXPORT_FORMATS)), status_code=400)
+    since = request.args.get("since")
+    try:
+        since = int(since) if since else None
+    except ValueError:
+        raise InvalidUsage("since must be an integer", status_code=400)
+    try:
+        clean = parse_clean(request.args.get("clean"))
+    except ValueError as e:
+        raise InvalidUsage(str(e), status_code=400)
+
+    db = get_db()
+    try:
+        batches = db.stream_export(clean, since, comments_requested())
+        first = next(batches, [])
+    except sqlite3.Error as e:
+        logging.error(e)
+        raise InvalidUsage(str(e))
+    return Response(format_batches(itertools.chain([first], batches), export_format),
+                    mimetype=EXPORT_FORMATS[export_format])
+
+
+# Defaults and limits of /changes
+CHANGES_LIMIT = 100
+CHANGES_MAX_LIMIT = 1000
+
+@app.route("/changes", methods=["GET"])
+def changes():
+    """
+    Returns the change feed entries after ?after= (a seq from an earlier call,
+    0 to start from the beginning), at most ?limit= of them, with last_seq to
+    pass as ?after= next time. Only committed changes are returned.
+
+    The server handles one request at a time, so the feed does not long-poll:
+    a waiting request would hold up the very writes it waits for. Clients poll
+    again after an empty response.
+    """
+    if app.config.get("shards"):
+        raise InvalidUsage("the change feed is not available with --shards", status_code=400)
+    try:
+        after = int(request.args.get("after", 0))
+        limit = int(request.args.get("limit", CHANGES_LIMIT))
+    except ValueError:
+        raise InvalidUsage("after and limit must be integers", status_code=400)
+    if not 1 <= limit <= CHANGES_MAX_LIMIT:
+        raise InvalidUsage("limit must be between 1 and %d" % CHANGES_MAX_LIMIT, status_code=400)
+
+    db = DB(get_read_conn())
+    try:
+        res = db.find_changes(after, limit)
+    except sqlite3.Error as e:
+        logging.error(e)
+        raise InvalidUsage(str(e))
+    return jsonify({"changes": res, "last_seq": res[-1]["seq"] if res else after}), 200
+
+
+def parse_date_arg(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        raise InvalidUsage("%s must be a YYYY-MM-DD date" % name, status_code=400)
+
+
+def comments_requested():
+    # ?comments=false leaves out the violation comments
+    return request.args.get("comments", "true").lower() != "false"
+
+
 @app.route("/txn/<int:txnsize>", methods=["GET"])
 def set_transaction_size(txnsize):
     # TODO milestone 2
@@ -183,7 +493,7 @@ def set_transaction_size(txnsize):
 def commit_txn():
     logging.info("Committing active transactions")
     # TODO milestone 2
-    db = DB(get_db_conn())
+    db = get_db()
     if app.config["ACTIVE_TRANSACTION"]:
         db.conn.commit()
         app.config["ACTIVE_TRANSACTION"] == False
@@ -198,7 +508,7 @@ def commit_txn():
 def abort_txn():
     logging.info("Aborting/rolling back active transactions")
     # TODO milestone 2
-    db = DB(get_db_conn())
+    db = get_db()
     if app.config["INSPECTION_IN_TRANSACTION"] == 0:
         return Response(status=200)
     else:
@@ -212,7 +522,7 @@ def abort_txn():
 def count_insp():
     logging.info("Counting Inspections")
     # TODO milestone 2
-    db = DB(get_db_conn())
+    db = get_db()
     count, httpResponseCode = db.count_inspection_records()
     return str(count), httpResponseCode
 
@@ -233,7 +543,7 @@ def ngrams(tweet, n):
 def tweet():
     logging.info("Checking Tweet")
     # TODO milestone 2
-    db = DB(get_db_conn())
+    db = get_db()
     post_body = request.get_json() # parse the incoming JSON request data into dicts
     if not post_body:
         logging.error("No post body")
@@ -256,7 +566,7 @@ def find_restaurant_tweets(restaurant_id):
     """
     Returns a restaurant's associated tweets (tkey and match).
     """
-    db = DB(get_db_conn())
+    db = get_db()
 
     # TODO milestone 2
     try:
@@ -274,12 +584,44 @@ def find_restaurant_tweets(restaurant_id):
 def clean():
     logging.info("Cleaning Restaurants")
     # TODO milestone 3
-    db = DB(get_db_conn())
-    if app.config['scaling'] == True:
-        db.match_restaurant_blocking()
+    db = get_db()
+    if app.config['clean_jobs'] is not None:
+        job_id = app.config['clean_jobs'].start(db)
+        return jsonify({"job_id": job_id}), 202
+    if app.config['incremental'] == True:
+        stats = db.match_restaurant_incremental()
+    elif app.config['blocker']:
+        stats = db.match_restaurant_blocker(make_blocker(app.config['blocker']))
+    elif app.config['scaling'] == True:
+        stats = db.match_restaurant_blocking(stream=app.config['stream_blocks'],
+                                            max_block_size=app.config['max_block_size'])
     else:
-        db.match_restaurant()
-    return Response(status=200)
+        stats = db.match_restaurant()
+    logging.info("Cleaning stats : %s" % stats)
+    return jsonify(stats), 200
+
+@app.route("/clean/<int:job_id>", methods=["GET"])
+def clean_job_status(job_id):
+    """
+    Returns the progress of a background cleaning job.
+    """
+    db = get_db()
+    try:
+        job = db.find_clean_job(job_id)
+    except sqlite3.Error as e:
+        logging.error(e)
+        raise InvalidUsage(str(e))
+    if job is None:
+        raise InvalidUsage("No clean job %d" % job_id, status_code=404)
+    return jsonify(job), 200
+
+
+@app.route("/clean/<int:job_id>/cancel", methods=["GET", "POST"])
+def cancel_clean_job(job_id):
+    logging.info("Cancelling clean job %d" % job_id)
+    if app.config['clean_jobs'] is None or not app.config['clean_jobs'].cancel(job_id):
+        raise InvalidUsage("Clean job %d is not running" % job_id, status_code=404)
+    return clean_job_status(job_id)
 
 # -----------------
 # Web APIs
@@ -298,7 +640,7 @@ def query():
         # Ensure query was submitted
 
         # get DB class with new connection
-        db = DB(get_db_conn())
+        db = get_db()
 
         # note DO NOT EVER DO THIS NORMALLY (run SQL from a client/web directly)
         # https://xkcd.com/327/
@@ -433,6 +775,66 @@ if __name__ == "__main__":
         default=False,
         action="store_true"
     )
+    parser.add_argument(
+        "-i", "--incremental",
+        help="Only clean newly loaded restaurants against existing clusters",
+        default=False,
+        action="store_true"
+    )
+    parser.add_argument(
+        "--stream-blocks",
+        help="With --scaling, read the blocks in one ordered scan instead of a query per block",
+        default=False,
+        action="store_true"
+    )
+    parser.add_argument(
+        "--max-block-size",
+        help="With --scaling or --jobs, split blocks larger than this by street number, name and location",
+        default=None,
+        type=int
+    )
+    parser.add_argument(
+        "-b", "--blocker",
+        help="Clean with a pluggable blocker instead of the zip/name temp table",
+        default=None,
+        choices=sorted(BLOCKERS)
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        help="Run /clean as a resumable background job and return its id",
+        default=False,
+        action="store_true"
+    )
+    parser.add_argument(
+        "--shards",
+        help="Partition restaurants by zip across this many database files (with -s, -i or -b prefix)",
+        default=None,
+        type=int
+    )
+    parser.add_argument(
+        "-z", "--compress-comments",
+        help="Store violation comments zlib compressed",
+        default=False,
+        action="store_true"
+    )
+    parser.add_argument(
+        "--slow-query-ms",
+        help="Log SQL statements slower than this many milliseconds, 0 to turn off (default 250)",
+        default=250,
+        type=float
+    )
+    parser.add_argument(
+        "--explain",
+        help="Debug mode: record the query plan of every distinct SQL statement for /explain",
+        default=False,
+        action="store_true"
+    )
+    parser.add_argument(
+        "--profile-rate",
+        help="Share of requests to run under cProfile for /profile/stats (default 0, header X-Profile: 1 only)",
+        default=0.0,
+        type=float
+    )
     parser.add_argument(
         "-l", "--log",
         help="Set the log level (debug,info,warning,error)",
@@ -445,6 +847,12 @@ if __name__ == "__main__":
     
     # Create the parser argument object
     args = parser.parse_args()
+    if args.shards and args.jobs:
+        parser.error("--shards cannot be combined with --jobs")
+    # each shard is cleaned on its own, so only cleaning within a zip finds every match
+    zip_blocked = args.incremental or (args.blocker == "prefix" if args.blocker else args.scaling)
+    if args.shards and not zip_blocked:
+        parser.error("--shards needs cleaning blocked by zip (-s, -i or -b prefix)")
     if args.log == 'debug':
         logging.basicConfig(
             format=log_fmt, level=logging.DEBUG)
@@ -478,6 +886,29 @@ if __name__ == "__main__":
         app.config['scaling'] = True
     else:
         app.config['scaling'] = False
+    app.config['incremental'] = args.incremental
+    app.config['blocker'] = args.blocker
+    app.config['stream_blocks'] = args.stream_blocks
+    app.config['max_block_size'] = args.max_block_size
+    app.config['compress_comments'] = args.compress_comments
+    app.config['shards'] = args.shards
+    METRICS.slow_query_seconds = args.slow_query_ms / 1000
+    if args.explain:
+        METRICS.audit = PLANS
+    PROFILER.rate = args.profile_rate
     logging.info("Scaling set to %s" % app.config['scaling'])
+    logging.info("Incremental cleaning set to %s" % app.config['incremental'])
+    logging.info("Blocker set to %s" % app.config['blocker'])
+
+    if args.shards:
+        # finish commits across shards a previous server process did not get to complete
+        get_db().recover()
+    app.config['clean_jobs'] = JobManager(DATABASE, args.max_block_size) if args.jobs else None
+    if args.jobs:
+        try:
+            app.config['clean_jobs'].resume(get_db())
+        except sqlite3.Error as e:
+            # nothing to resume before /create has run
+            logging.info("No clean jobs resumed: %s" % e)
     logging.info("Starting Inspection Service")
     app.run(host=args.host, port=args.port, threaded=False)
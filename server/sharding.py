@@ -0,0 +1,369 @@
+"""
+Sharded storage. Restaurants and their inspections are partitioned by zip range
+across several SQLite files (insp-0.db, insp-1.db, ...), each with the full
+schema and its own connection, so each shard's tables and indexes stay smaller
+and shards commit in parallel. ShardedDB has the same interface as DB: point
+lookups are routed to one shard, everything else is scattered to all shards and
+gathered. A commit spanning shards first writes their pending inserts to a
+commit log (insp-log.db), so a commit cut short on some shards is finished by
+replaying the log when the server starts again (see ShardedConnection).
+
+Restaurant ids are globally unique: shard i hands out ids from i * SHARD_ID_SPACE,
+so a restaurant id alone tells which shard holds it. Each shard is cleaned on its
+own, all of them in parallel, which only finds every match when the cleaning
+compares restaurants within a zip (blocked, incremental or the prefix blocker);
+all-pairs cleaning and the other blockers would miss matches across shards, so
+the server rejects them with --shards.
+"""
+import bisect
+import heapq
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from db import DB, STREAM_BATCH_SIZE, ROLLUP_GROUPS, add_rollup_rates
+from metrics import InstrumentedConnection
+
+# Restaurant ids available to each shard
+SHARD_ID_SPACE = 10 ** 9
+
+# Zip codes split evenly between the shards, the range covering Chicago
+ZIP_RANGE = (60601, 60661)
+
+
+# Transactions whose commit spanned several shards, with each shard's writes
+LOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ri_shard_txns (id integer PRIMARY KEY AUTOINCREMENT);
+CREATE TABLE IF NOT EXISTS ri_shard_log (
+    txn_id integer NOT NULL,
+    shard integer NOT NULL,
+    operations text NOT NULL,
+    PRIMARY KEY (txn_id, shard)
+);
+"""
+
+# Logged transactions a shard has committed, written in the transaction itself
+SHARD_SCHEMA = "CREATE TABLE IF NOT EXISTS ri_shard_commits (txn_id integer PRIMARY KEY)"
+
+
+def shard_paths(database, shards):
+    # insp.db -> insp-0.db, insp-1.db, ...
+    root, ext = os.path.splitext(database)
+    return ["%s-%d%s" % (root, i, ext) for i in range(shards)]
+
+def log_path(database):
+    # insp.db -> insp-log.db
+    root, ext = os.path.splitext(database)
+    return "%s-log%s" % (root, ext)
+
+
+class ZipRouter:
+    """
+    Maps a zip code to a shard. boundaries holds the first zip of every shard
+    but the first, zips that are missing or not numeric go to shard 0.
+    """
+    def __init__(self, boundaries):
+        self.boundaries = list(boundaries)
+
+    @classmethod
+    def even(cls, shards, zip_range=ZIP_RANGE):
+        low, high = zip_range
+        step = (high - low + 1) / shards
+        return cls(int(low + step * i) for i in range(1, shards))
+
+    def shard_for_zip(self, zip):
+        try:
+            zip = int(str(zip).strip()[:5])
+        except ValueError:
+            return 0
+        return bisect.bisect_right(self.boundaries, zip)
+
+
+class ShardConnection(InstrumentedConnection):
+    """
+    A shard's connection. Keeps the writes made since its last commit or
+    rollback as (DB method, arguments), so they can be logged and replayed.
+    """
+    def __init__(self, *args, **kwargs):
+        InstrumentedConnection.__init__(self, *args, **kwargs)
+        self.operations = []
+
+    def commit(self):
+        InstrumentedConnection.commit(self)
+        self.operations = []
+
+    def rollback(self):
+        InstrumentedConnection.rollback(self)
+        self.operations = []
+
+
+class ShardedConnection:
+    """
+    Stands in for the single connection the server commits and rolls back.
+    A transaction open on one shard simply commits there. One open on several
+    shards is logged first: each shard's operations go to the commit log, each
+    shard records the transaction id in ri_shard_commits as part of it, then
+    the shards commit in parallel and the log entry is dropped. A crash in
+    between leaves the entry, and ShardedDB.recover replays it on the shards
+    that have no record of the transaction.
+    """
+    def __init__(self, connections, log):
+        self.connections = connections
+        self.log = log
+
+    def commit(self):
+        pending = [(i, conn) for i, conn in enumerate(self.connections) if conn.in_transaction]
+        if len(pending) <= 1:
+            for _, conn in pending:
+                conn.commit()
+            return
+        c = self.log.cursor()
+        c.execute("INSERT INTO ri_shard_txns DEFAULT VALUES")
+        txn_id = c.lastrowid
+        c.executemany("INSERT INTO ri_shard_log (txn_id, shard, operations) VALUES (?, ?, ?)",
+                      [(txn_id, i, json.dumps(conn.operations)) for i, conn in pending])
+        self.log.commit()
+        for _, conn in pending:
+            conn.execute("INSERT INTO ri_shard_commits (txn_id) VALUES (?)", (txn_id,))
+        with ThreadPoolExecutor(max_workers=len(pending)) as pool:
+            list(pool.map(lambda conn: conn.commit(), [conn for _, conn in pending]))
+        self.log.execute("DELETE FROM ri_shard_log WHERE txn_id = ?", (txn_id,))
+        self.log.commit()
+
+    def rollback(self):
+        for conn in self.connections:
+            conn.rollback()
+
+    def close(self):
+        for conn in self.connections:
+            conn.close()
+        self.log.close()
+
+
+def clean_shard(path, method, args):
+    # runs in a worker process with its own connection to the shard
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        return getattr(DB(conn), method)(*args)
+    finally:
+        conn.close()
+
+
+class ShardedDB:
+    def __init__(self, paths, router, log):
+        self.paths = paths
+        self.router = router
+        # committed from worker threads, see ShardedConnection.commit
+        self.shards = [DB(sqlite3.connect(p, factory=ShardConnection, check_same_thread=False)) for p in paths]
+        for shard in self.shards:
+            shard.conn.execute(SHARD_SCHEMA)
+        log_conn = sqlite3.connect(log)
+        log_conn.executescript(LOG_SCHEMA)
+        self.conn = ShardedConnection([shard.conn for shard in self.shards], log_conn)
+
+    @classmethod
+    def open(cls, database, shards):
+        return cls(shard_paths(database, shards), ZipRouter.even(shards), log_path(database))
+
+    def recover(self):
+        """
+        Finishes commits that spanned shards and were cut short, replaying the
+        logged operations on every shard without a record of the transaction.
+        Only safe while nothing else writes, i.e. when the server starts.
+        """
+        log = self.conn.log
+        for txn_id, index, operations in log.execute("SELECT txn_id, shard, operations FROM ri_shard_log "
+                                                     "ORDER BY txn_id, shard").fetchall():
+            shard = self.shards[index]
+            if shard.conn.execute("SELECT 1 FROM ri_shard_commits WHERE txn_id = ?", (txn_id,)).fetchone():
+                continue
+            operations = json.loads(operations)
+            logging.warning("Replaying %d writes of transaction %d on shard %d" % (len(operations), txn_id, index))
+            for method, args in operations:
+                getattr(shard, method)(*args)
+            shard.conn.execute("INSERT INTO ri_shard_commits (txn_id) VALUES (?)", (txn_id,))
+            shard.conn.commit()
+        self.forget_commits()
+
+    def forget_commits(self):
+        # once no logged transaction is left unfinished, the shards' records of them are not needed
+        for shard in self.shards:
+            shard.conn.execute("DELETE FROM ri_shard_commits")
+            shard.conn.commit()
+        self.conn.log.execute("DELETE FROM ri_shard_log")
+        self.conn.log.commit()
+
+    # Routing
+    def shard_for_restaurant(self, restaurant_id):
+        index = int(restaurant_id) // SHARD_ID_SPACE
+        return self.shards[index] if 0 <= index < len(self.shards) else self.shards[0]
+
+    def shard_for_inspection(self, inspection_id):
+        # inspection ids come from the client, so the shard holding one is looked up
+        for shard in self.shards:
+            if shard.conn.execute("SELECT 1 FROM ri_inspections WHERE id = ?", (inspection_id,)).fetchone():
+                return shard
+        return self.shards[0]
+
+    # Schema
+    def create_script(self):
+        for i, shard in enumerate(self.shards):
+            shard.create_script()
+            if i > 0:
+                shard.conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('ri_restaurants', ?)",
+                                   (i * SHARD_ID_SPACE,))
+                shard.conn.commit()
+        self.forget_commits()
+
+    def seed_data(self):
+        """
+        Seeds the shard owning the seed restaurant's zip, found by running
+        schema/seed.sql on a scratch in-memory database first.
+        """
+        scratch = DB(sqlite3.connect(":memory:"))
+        try:
+            scratch.create_script()
+            scratch.seed_data()
+            zip = scratch.conn.execute("SELECT zip FROM ri_restaurants").fetchone()[0]
+        finally:
+            scratch.conn.close()
+        self.shards[self.router.shard_for_zip(zip)].seed_data()
+
+    # Point lookups
+    def find_restaurant(self, restaurant_id):
+        return self.shard_for_restaurant(restaurant_id).find_restaurant(restaurant_id)
+
+    def find_inspections(self, restaurant_id, comments=True):
+        return self.shard_for_restaurant(restaurant_id).find_inspections(restaurant_id, comments)
+
+    def find_restaurant_tweet_by_restaurant_id(self, restaurant_id):
+        return self.shard_for_restaurant(restaurant_id).find_restaurant_tweet_by_restaurant_id(restaurant_id)
+
+    def find_restaurant_by_inspection_id(self, inspection_id):
+        return self.shard_for_inspection(inspection_id).find_restaurant_by_inspection_id(inspection_id)
+
+    def find_linked_restaurants_by_inspection_id(self, inspection_id):
+        # clusters are built per shard, so all linked restaurants share the shard
+        return self.shard_for_inspection(inspection_id).find_linked_restaurants_by_inspection_id(inspection_id)
+
+    # Writes
+    def add_inspection_for_restaurant(self, inspection, restaurant, compress_comments=False):
+        shard = self.shards[self.router.shard_for_zip(restaurant.get("zip"))]
+        # logged with the shard's other uncommitted writes, see ShardedConnection.commit
+        shard.conn.operations.append(("add_inspection_for_restaurant", [inspection, restaurant, compress_comments]))
+        try:
+            return shard.add_inspection_for_restaurant(inspection, restaurant, compress_comments)
+        except Exception:
+            shard.conn.operations.pop()
+            raise
+
+    def add_tweet(self, tweet):
+        matched = []
+        for shard in self.shards:
+            matched.extend(shard.add_tweet(tweet))
+        return matched
+
+    def rollback(self):
+        for shard in self.shards:
+            if shard.conn.in_transaction:
+                shard.conn.rollback()
+
+    # Scatter-gather reads
+    def count_inspection_records(self):
+        return sum(shard.count_inspection_records()[0] for shard in self.shards), 200
+
+    def run_query(self, query):
+        res = []
+        for shard in self.shards:
+            res.extend(shard.run_query(query))
+        return res
+
+    def find_restaurants_near(self, lat, long, radius, limit):
+        nearest = heapq.merge(*(shard.find_restaurants_near(lat, long, radius, limit) for shard in self.shards),
+                              key=lambda restaurant: (restaurant["distance"], restaurant["id"]))
+        return list(nearest)[:limit]
+
+    def find_stats(self, group_by=ROLLUP_GROUPS, zip=None, facility_type=None, start_month=None, end_month=None):
+        totals = {}
+        for shard in self.shards:
+            for row in shard.find_stats(group_by, zip, facility_type, start_month, end_month):
+                key = tuple(row[g] for g in group_by)
+                total = totals.setdefault(key, dict({g: row[g] for g in group_by}, inspections=0, passed=0,
+                                                    failed=0, conditional=0))
+                for count in ("inspections", "passed", "failed", "conditional"):
+                    total[count] += row[count]
+        return [add_rollup_rates(totals[key]) for key in sorted(totals)]
+
+    def search(self, terms, limit=20, offset=0, kind=None):
+        """
+        Merges each shard's best limit + offset results by rank. Ranks come from
+        per-shard statistics, so the order across shards is approximate.
+        """
+        ranked = heapq.merge(*(shard.search(terms, limit + offset, 0, kind) for shard in self.shards),
+                             key=lambda result: result["rank"])
+        return list(ranked)[offset:offset + limit]
+
+    def stream_inspections(self, start=None, end=None, result=None, comments=True):
+        """
+        Merges the shards' date ordered streams into one, in batches.
+        """
+        streams = [(inspection for batch in shard.stream_inspections(start, end, result, comments) for inspection in batch)
+                   for shard in self.shards]
+        batch = []
+        for inspection in heapq.merge(*streams, key=lambda i: (i["inspection_date"] or "", i["restaurant_id"])):
+            batch.append(inspection)
+            if len(batch) == STREAM_BATCH_SIZE:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def stream_export(self, clean=None, since=None, comments=True):
+        """
+        Exports the shards one after another. seq is offset by SHARD_ID_SPACE per
+        shard like restaurant ids, so it keeps increasing across shards and since
+        resumes inside the right shard. Inspections loaded into an earlier shard
+        after an export moved past it are only picked up by a full export.
+        """
+        for i, shard in enumerate(self.shards):
+            offset = i * SHARD_ID_SPACE
+            shard_since = None
+            if since is not None:
+                if since >= offset + SHARD_ID_SPACE:
+                    continue
+                shard_since = max(since - offset, 0)
+            for batch in shard.stream_export(clean, shard_since, comments):
+                for row in batch:
+                    row["seq"] += offset
+                yield batch
+
+    def find_clean_job(self, job_id):
+        # background jobs are not available with shards
+        return None
+
+    # Cleaning, one worker process per shard
+    def clean_shards(self, method, *args):
+        self.conn.commit()
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=len(self.paths), mp_context=context) as pool:
+            shard_stats = list(pool.map(clean_shard, self.paths, [method] * len(self.paths),
+                                        [args] * len(self.paths)))
+        return {
+            "mode": "sharded",
+            "restaurants": sum(stats["restaurants"] for stats in shard_stats if "restaurants" in stats),
+            "shards": shard_stats,
+        }
+
+    def match_restaurant(self):
+        return self.clean_shards("match_restaurant")
+
+    def match_restaurant_blocking(self, stream=False, max_block_size=None):
+        return self.clean_shards("match_restaurant_blocking", stream, max_block_size)
+
+    def match_restaurant_blocker(self, blocker):
+        return self.clean_shards("match_restaurant_blocker", blocker)
+
+    def match_restaurant_incremental(self):
+        return self.clean_shards("match_restaurant_incremental")
@@ -0,0 +1,59 @@
+"""
+Storage of inspection violations. The narrative posted with an inspection is a
+" | " separated list of "<code>. <DESCRIPTION> - Comments: <comments>" items.
+It is split into ri_violations rows pointing at a shared ri_violation_types row
+per (code, description), and put back together when inspections are read.
+Comments can be stored zlib-compressed and are only decompressed when asked for.
+
+Only narratives that format back to exactly the posted text are split, anything
+else is kept verbatim in ri_inspections.violations.
+"""
+import re
+import zlib
+
+ITEM_SEPARATOR = " | "
+COMMENTS_SEPARATOR = " - Comments: "
+ITEM_PATTERN = re.compile(r"(\d+)\. (.*?)(?: - Comments: (.*))?", re.DOTALL)
+
+# Comments shorter than this are stored as text, compressing them would not pay off
+COMPRESS_MIN_LENGTH = 64
+
+
+def parse_violations(text):
+    """
+    Returns the (code, description, comments) items of a violations narrative,
+    or None when it is empty or would not format back to the same text.
+    comments is None for items without a comments part.
+    """
+    if not text:
+        return None
+    items = []
+    for item in text.split(ITEM_SEPARATOR):
+        match = ITEM_PATTERN.fullmatch(item)
+        if match is None:
+            return None
+        items.append((int(match.group(1)), match.group(2), match.group(3)))
+    if format_violations(items) != text:
+        return None
+    return items
+
+def format_item(code, description, comments):
+    if comments is None:
+        return "%d. %s" % (code, description)
+    return "%d. %s%s%s" % (code, description, COMMENTS_SEPARATOR, comments)
+
+def format_violations(items):
+    return ITEM_SEPARATOR.join(format_item(*item) for item in items)
+
+
+def pack_comments(comments, compress):
+    # compressed comments are stored as a BLOB, plain ones as TEXT
+    if comments is None or not compress or len(comments) < COMPRESS_MIN_LENGTH:
+        return comments
+    packed = zlib.compress(comments.encode("utf-8"))
+    return packed if len(packed) < len(comments) else comments
+
+def unpack_comments(value):
+    if isinstance(value, bytes):
+        return zlib.decompress(value).decode("utf-8")
+    return value
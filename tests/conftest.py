@@ -0,0 +1,59 @@
+import json
+import os
+import sqlite3
+import sys
+
+import pytest
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server")
+sys.path.insert(0, SERVER_DIR)
+
+from db import DB  # noqa: E402
+
+
+@pytest.fixture
+def server_cwd(monkeypatch):
+    # create_script and seed_data read schema/*.sql relative to the server
+    monkeypatch.chdir(SERVER_DIR)
+
+
+@pytest.fixture
+def database(tmp_path, server_cwd):
+    """
+    Path of a fresh database with the server's schema.
+    """
+    path = str(tmp_path / "insp.db")
+    conn = sqlite3.connect(path)
+    DB(conn).create_script()
+    conn.close()
+    return path
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+
+# Keys of a posted value that belong to the restaurant and to the inspection, as in server.py
+KEY_RESTAURANT = ["name", "facility_type", "address", "city", "state", "zip", "latitude", "longitude"]
+KEY_INSPECTION = ["inspection_id", "risk", "date", "inspection_type", "results", "violations"]
+
+
+def post_values(db, test_file, compress_comments=False):
+    # loads a client test file (post_path/values) the way POST /inspections does
+    with open(os.path.join(DATA_DIR, test_file), "r") as values_file:
+        values = json.load(values_file)["values"]
+    for value in values:
+        db.add_inspection_for_restaurant({k: v for k, v in value.items() if k in KEY_INSPECTION},
+                                         {k: v for k, v in value.items() if k in KEY_RESTAURANT}, compress_comments)
+    db.conn.commit()
+    return values
+
+
+@pytest.fixture
+def dirty_db(database):
+    """
+    A DB with data/ms3/chiDirty100.json loaded and not cleaned yet.
+    """
+    conn = sqlite3.connect(database)
+    db = DB(conn)
+    post_values(db, os.path.join("ms3", "chiDirty100.json"))
+    yield db
+    conn.close()
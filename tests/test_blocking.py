@@ -0,0 +1,44 @@
+import pytest
+
+from blocking import BLOCKERS, Blocker, make_blocker, split_block
+from matching import RestaurantRecord
+
+
+def make_record(id, name="GOLDEN DRAGON", address="123 MAIN ST"):
+    return RestaurantRecord(id, name, address, "CHICAGO", "IL", "60601", 41.8825, -87.6232,
+                            name.lower(), address.lower(), "chicago")
+
+
+def test_unsplittable_block_is_chunked():
+    # same name, address, zip and location: none of the split keys divides them
+    records = [make_record(id) for id in range(1, 26)]
+    sub_blocks = split_block(records, 10)
+    assert [len(block) for block in sub_blocks] == [10, 10, 5]
+    assert sorted(r.id for block in sub_blocks for r in block) == list(range(1, 26))
+
+
+def test_chunks_keep_similar_records_together():
+    # the names share their prefix, so only the sorted chunking separates them
+    records = [make_record(id, name="CAFE A" if id % 2 else "CAFE B") for id in range(1, 21)]
+    sub_blocks = split_block(records, 10)
+    assert [{r.name for r in block} for block in sub_blocks] == [{"CAFE A"}, {"CAFE B"}]
+
+
+def test_small_block_is_returned_whole():
+    records = [make_record(id) for id in range(1, 6)]
+    assert split_block(records, 10) == [records]
+
+
+def test_blocker_requires_candidate_pairs():
+    with pytest.raises(TypeError):
+        Blocker()
+
+
+@pytest.mark.parametrize("name", sorted(BLOCKERS))
+def test_every_blocker_pairs_duplicates(name):
+    records = [make_record(1), make_record(2), make_record(3, name="BLUE MOON", address="9 OAK AVE")]
+    blocker = make_blocker(name)
+    pairs = blocker.candidate_pairs(records)
+    assert (1, 2) in pairs
+    assert all(a < b for a, b in pairs)
+    assert blocker.stats["candidate_pairs"] == len(pairs)
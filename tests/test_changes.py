@@ -0,0 +1,40 @@
+def kinds(changes):
+    return [change["kind"] for change in changes]
+
+
+def test_every_inspection_is_in_the_feed(dirty_db):
+    changes = dirty_db.find_changes(limit=1000)
+    inspections = dirty_db.conn.execute("SELECT id, restaurant_id, results FROM ri_inspections ORDER BY seq").fetchall()
+    assert [(c["item_id"], c["restaurant_id"], c["detail"]) for c in changes] == inspections
+    assert set(kinds(changes)) == {"inspection"}
+    assert [c["seq"] for c in changes] == sorted(c["seq"] for c in changes)
+
+
+def test_tweet_matches_are_in_the_feed(dirty_db):
+    last_seq = dirty_db.find_changes(limit=1000)[-1]["seq"]
+    name, latitude, longitude = dirty_db.conn.execute(
+        "SELECT name, latitude, longitude FROM ri_restaurants ORDER BY id LIMIT 1").fetchone()
+    matched = dirty_db.add_tweet({"key": "t1", "lat": latitude, "long": longitude, "text": "lunch at %s" % name})
+    changes = dirty_db.find_changes(after=last_seq)
+    assert matched
+    assert kinds(changes) == ["tweet"] * len(changes)
+    assert sorted((c["item_id"], c["restaurant_id"], c["detail"]) for c in changes) == sorted(
+        dirty_db.conn.execute("SELECT tkey, restaurant_id, match FROM ri_tweetmatch").fetchall())
+
+
+def test_relinks_are_in_the_feed(dirty_db):
+    last_seq = dirty_db.find_changes(limit=1000)[-1]["seq"]
+    dirty_db.match_restaurant_blocking()
+    changes = dirty_db.find_changes(after=last_seq, limit=1000)
+    linked = dirty_db.conn.execute("""SELECT original_rest_id, primary_rest_id FROM ri_linked
+                                      WHERE original_rest_id != primary_rest_id ORDER BY original_rest_id""").fetchall()
+    assert linked
+    assert kinds(changes) == ["relink"] * len(changes)
+    assert sorted((int(c["item_id"]), c["restaurant_id"]) for c in changes) == linked
+
+
+def test_feed_pages_by_seq(dirty_db):
+    first = dirty_db.find_changes(limit=10)
+    second = dirty_db.find_changes(after=first[-1]["seq"], limit=10)
+    assert len(first) == len(second) == 10
+    assert second[0]["seq"] > first[-1]["seq"]
@@ -0,0 +1,30 @@
+import pytest
+
+from export import parse_clean
+
+
+def export_rows(db, since=None):
+    return [(row["seq"], row["id"]) for batch in db.stream_export(since=since) for row in batch]
+
+
+def test_seq_survives_vacuum(dirty_db):
+    before = export_rows(dirty_db)
+    hits = {result["id"] for result in dirty_db.search(["rodent"], limit=100, kind="inspection")}
+    assert hits
+    # deleted rows leave gaps VACUUM would close up in an implicit rowid
+    dirty_db.conn.execute("DELETE FROM ri_inspections WHERE seq <= 5")
+    dirty_db.conn.commit()
+    dirty_db.conn.execute("VACUUM")
+    assert export_rows(dirty_db) == before[5:]
+    assert export_rows(dirty_db, since=before[20][0]) == before[21:]
+    remaining = {id for _, id in before[5:]}
+    assert {result["id"] for result in dirty_db.search(["rodent"], limit=100, kind="inspection")} == hits & remaining
+
+
+def test_parse_clean():
+    assert parse_clean(None) is None
+    assert parse_clean("") is None
+    assert parse_clean("TRUE") is True
+    assert parse_clean("false") is False
+    with pytest.raises(ValueError):
+        parse_clean("yes")
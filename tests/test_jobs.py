@@ -0,0 +1,59 @@
+import sqlite3
+import threading
+
+import jobs
+from db import DB
+from jobs import CleanJob, JobManager
+
+
+def job_row(database, job_id):
+    conn = sqlite3.connect(database)
+    try:
+        return conn.execute("SELECT status, error, resumes FROM ri_clean_jobs WHERE id = ?", (job_id,)).fetchone()
+    finally:
+        conn.close()
+
+
+def create_job(database):
+    conn = sqlite3.connect(database)
+    try:
+        return DB(conn).create_clean_job()
+    finally:
+        conn.close()
+
+
+def test_unexpected_error_marks_job_failed(database, monkeypatch):
+    def crash(self, job_id, cancelled, max_block_size=None):
+        raise KeyError("zip")
+    monkeypatch.setattr(DB, "match_restaurant_job", crash)
+    job_id = create_job(database)
+    CleanJob(database, job_id).run()
+    assert job_row(database, job_id)[:2] == ("failed", "'zip'")
+
+
+def test_failure_is_recorded_once_the_lock_is_released(database, monkeypatch):
+    def crash(self, job_id, cancelled, max_block_size=None):
+        raise RuntimeError("boom")
+    monkeypatch.setattr(DB, "match_restaurant_job", crash)
+    monkeypatch.setattr(jobs, "FINISH_TIMEOUT", 0.2)
+    job_id = create_job(database)
+    # another connection holds the write lock, like an open /txn
+    blocker = sqlite3.connect(database, check_same_thread=False)
+    blocker.execute("BEGIN IMMEDIATE")
+    threading.Timer(0.3, blocker.rollback).start()
+    CleanJob(database, job_id).run()
+    blocker.close()
+    assert job_row(database, job_id)[:2] == ("failed", "boom")
+
+
+def test_job_left_running_again_is_not_resumed(database):
+    job_id = create_job(database)
+    conn = sqlite3.connect(database)
+    db = DB(conn)
+    manager = JobManager(database)
+    manager.launch = lambda job_id: job_id  # the job never finishes, as if the server died
+    manager.resume(db)
+    assert job_row(database, job_id) == ("running", None, 1)
+    manager.resume(db)
+    assert job_row(database, job_id) == ("failed", "left running after 1 resumes", 1)
+    conn.close()
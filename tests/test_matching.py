@@ -0,0 +1,46 @@
+import json
+import os
+import sys
+
+import pytest
+
+from matching import MATCH_THRESHOLD, Matcher, RestaurantRecord, restaurant_similarity
+from normalize import normalize_restaurant
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bench"))
+
+from gen_dirty import generate  # noqa: E402
+
+
+def to_records(values):
+    records = []
+    for i, value in enumerate(values):
+        name_norm, address_norm, city_norm = normalize_restaurant(value)
+        records.append(RestaurantRecord.from_dict(dict(value, id=i + 1, name_norm=name_norm,
+                                                       address_norm=address_norm, city_norm=city_norm)))
+    return records
+
+
+def chi_dirty():
+    with open(os.path.join(DATA_DIR, "ms3", "chiDirty100.json"), "r") as test_file:
+        return json.load(test_file)["values"]
+
+
+@pytest.mark.parametrize("values", [chi_dirty(), generate(300, seed=30235)], ids=["chiDirty100", "generated"])
+def test_matcher_decides_like_the_full_score(values):
+    # pruning and the similarity cache must never change a decision or a score
+    records = to_records(values)
+    matcher = Matcher()
+    matches = 0
+    for i, restaurant in enumerate(records):
+        for match in records[i + 1:]:
+            expected = restaurant_similarity(restaurant, match)
+            score = matcher.score(restaurant, match)
+            if expected > MATCH_THRESHOLD:
+                assert score == expected
+                matches += 1
+            else:
+                assert score is None
+    assert matches > 0
+    assert matcher.stats["pruned_name"] + matcher.stats["pruned_address"] > 0
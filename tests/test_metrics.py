@@ -0,0 +1,23 @@
+import metrics
+from metrics import connect, statement_key
+
+
+def test_in_lists_of_any_length_share_a_key():
+    assert (statement_key("SELECT id FROM t WHERE a in (?) AND b IN (?)") ==
+            statement_key("SELECT id FROM t WHERE a in (?, ?,?) AND b IN (?,?)"))
+
+
+def test_executemany_is_audited(monkeypatch):
+    audited = []
+
+    class Audit:
+        def audit(self, connection, sql, parameters):
+            audited.append((sql, parameters))
+    monkeypatch.setattr(metrics.METRICS, "audit", Audit())
+    conn = connect(":memory:")
+    c = conn.cursor()
+    c.execute("CREATE TABLE t (a, b)")
+    c.executemany("INSERT INTO t VALUES (?, ?)", ((i, i * 2) for i in range(3)))
+    assert audited[-1] == ("INSERT INTO t VALUES (?, ?)", (0, 0))
+    assert conn.execute("SELECT count(*) FROM t").fetchone()[0] == 3
+    conn.close()
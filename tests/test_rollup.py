@@ -0,0 +1,34 @@
+import pytest
+
+from blocking import make_blocker
+
+CLEANERS = {
+    "all-pairs": lambda db: db.match_restaurant(),
+    "blocking": lambda db: db.match_restaurant_blocking(),
+    "blocking-split": lambda db: db.match_restaurant_blocking(max_block_size=2),
+    "incremental": lambda db: db.match_restaurant_incremental(),
+    "qgram": lambda db: db.match_restaurant_blocker(make_blocker("qgram")),
+}
+
+
+def rollup(db):
+    return db.conn.execute("""SELECT zip, facility_type, month, inspections, passed, failed, conditional
+                              FROM ri_inspection_rollup WHERE inspections > 0
+                              ORDER BY zip, facility_type, month""").fetchall()
+
+
+def test_rollup_counts_every_posted_inspection(dirty_db):
+    counted = rollup(dirty_db)
+    dirty_db.rebuild_rollup()
+    assert rollup(dirty_db) == counted
+
+
+@pytest.mark.parametrize("clean", sorted(CLEANERS))
+def test_rollup_follows_relinked_inspections(dirty_db, clean):
+    before = rollup(dirty_db)
+    CLEANERS[clean](dirty_db)
+    after = rollup(dirty_db)
+    # cleaning moved inspections to primaries with another zip or facility type
+    assert after != before
+    dirty_db.rebuild_rollup()
+    assert rollup(dirty_db) == after
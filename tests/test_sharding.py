@@ -0,0 +1,77 @@
+import sqlite3
+
+from sharding import ShardConnection, ShardedDB
+
+
+def post(inspection_id, name, zip):
+    inspection = {"inspection_id": inspection_id, "risk": "Risk 1 (High)", "date": "04/13/2016",
+                  "inspection_type": "License", "results": "Pass", "violations": ""}
+    restaurant = {"name": name, "facility_type": "Restaurant", "address": "1 W MAIN ST", "city": "CHICAGO",
+                  "state": "IL", "zip": zip, "latitude": 41.9, "longitude": -87.6}
+    return inspection, restaurant
+
+
+def open_sharded(tmp_path, shards):
+    return ShardedDB.open(str(tmp_path / "insp.db"), shards)
+
+
+def inspections_by_shard(db):
+    return [shard.conn.execute("SELECT id, restaurant_id FROM ri_inspections ORDER BY id").fetchall()
+            for shard in db.shards]
+
+
+def test_seed_restaurant_goes_to_the_shard_of_its_zip(tmp_path, server_cwd):
+    db = open_sharded(tmp_path, 6)
+    db.create_script()
+    db.seed_data()
+    index = db.router.shard_for_zip("60613")
+    assert index == 1
+    restaurant_id = db.shards[index].conn.execute("SELECT id FROM ri_restaurants").fetchone()[0]
+    assert db.shard_for_restaurant(restaurant_id) is db.shards[index]
+    assert [i["id"] for i in db.find_inspections(restaurant_id)] == ["1751552"]
+    db.conn.close()
+
+
+def test_commit_across_shards_clears_the_log(tmp_path, server_cwd):
+    db = open_sharded(tmp_path, 3)
+    db.create_script()
+    db.add_inspection_for_restaurant(*post("1", "A", "60601"))
+    db.add_inspection_for_restaurant(*post("2", "B", "60660"))
+    db.conn.commit()
+    assert inspections_by_shard(db) == [[("1", 1)], [], [("2", 2 * 10 ** 9 + 1)]]
+    assert db.conn.log.execute("SELECT count(*) FROM ri_shard_log").fetchone()[0] == 0
+    db.conn.close()
+
+
+def test_commit_cut_short_is_replayed_on_recovery(tmp_path, server_cwd, monkeypatch):
+    db = open_sharded(tmp_path, 3)
+    db.create_script()
+    db.add_inspection_for_restaurant(*post("1", "A", "60601"))
+    db.add_inspection_for_restaurant(*post("2", "B", "60660"))
+    db.add_inspection_for_restaurant(*post("3", "C", "60660"))
+
+    # the last shard never commits, as if the server died part way through
+    victim = db.shards[2].conn
+    commit = ShardConnection.commit
+
+    def crash(conn):
+        if conn is victim:
+            raise sqlite3.OperationalError("disk I/O error")
+        commit(conn)
+    monkeypatch.setattr(ShardConnection, "commit", crash)
+    try:
+        db.conn.commit()
+    except sqlite3.OperationalError:
+        pass
+    monkeypatch.undo()
+    db.conn.close()
+
+    db = open_sharded(tmp_path, 3)
+    assert inspections_by_shard(db)[2] == []
+    db.recover()
+    assert inspections_by_shard(db) == [[("1", 1)], [], [("2", 2 * 10 ** 9 + 1), ("3", 2 * 10 ** 9 + 2)]]
+    assert db.conn.log.execute("SELECT count(*) FROM ri_shard_log").fetchone()[0] == 0
+    # replaying again must not insert twice
+    db.recover()
+    assert len(inspections_by_shard(db)[2]) == 2
+    db.conn.close()
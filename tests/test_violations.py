@@ -0,0 +1,48 @@
+import sqlite3
+
+import pytest
+
+from db import DB
+from violations import COMPRESS_MIN_LENGTH, pack_comments, parse_violations, unpack_comments
+
+NARRATIVE = ("35. WALLS, CEILINGS, ATTACHED EQUIPMENT CONSTRUCTED PER CODE: GOOD REPAIR - Comments: "
+             + "DETAIL CLEAN WALLS IN PREP AREAS AS NEEDED. " * 4
+             + " | 36. LIGHTING: REQUIRED MINIMUM FOOT-CANDLES OF LIGHT PROVIDED - Comments: MUST REPLACE"
+             + " | 41. PREMISES MAINTAINED FREE OF LITTER")
+
+
+def post(db, inspection_id, violations, compress_comments):
+    inspection = {"inspection_id": inspection_id, "risk": "Risk 1 (High)", "date": "04/13/2016",
+                  "inspection_type": "Canvass", "results": "Pass", "violations": violations}
+    restaurant = {"name": "DAMEN DINING", "facility_type": "Restaurant", "address": "1000 W WAVELAND AVE",
+                  "city": "CHICAGO", "state": "IL", "zip": "60613", "latitude": 41.949, "longitude": -87.654}
+    db.add_inspection_for_restaurant(inspection, restaurant, compress_comments)
+    db.conn.commit()
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_comments_pack_and_unpack(compress):
+    for comments in (None, "SHORT", "X" * COMPRESS_MIN_LENGTH, "DETAIL CLEAN WALLS. " * 20):
+        assert unpack_comments(pack_comments(comments, compress)) == comments
+
+
+def test_narrative_that_does_not_format_back_is_not_split():
+    assert parse_violations("") is None
+    assert parse_violations("NOT A NUMBERED ITEM") is None
+    assert parse_violations("1. A | NOT NUMBERED") is None
+    assert parse_violations("1. A  | 2. B") == [(1, "A ", None), (2, "B", None)]
+    assert parse_violations("1. A | 2. B - Comments: C") == [(1, "A", None), (2, "B", "C")]
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_inspection_violations_round_trip(database, compress):
+    conn = sqlite3.connect(database)
+    db = DB(conn)
+    post(db, "1", NARRATIVE, compress)
+    post(db, "2", "NOT A NUMBERED ITEM", compress)
+    post(db, "3", "", compress)
+    inspections = db.find_inspections(1)
+    assert [i["violations"] for i in inspections] == [NARRATIVE, "NOT A NUMBERED ITEM", ""]
+    stored = conn.execute("SELECT comments FROM ri_violations WHERE inspection_id = '1' ORDER BY seq").fetchall()
+    assert [isinstance(comments, bytes) for comments, in stored] == [compress, False, False]
+    conn.close()